@@ -1,12 +1,13 @@
 import os
 import gzip
 import json
-import multiprocessing as mp
-
-from pathos.pools import ProcessPool
+import time
+import multiprocess as mp
+import multiprocess.connection
 
 from tqdm import tqdm
 from contextlib import contextmanager
+from collections import deque
 
 # Jsonl (GZ) handler --------------------------------------------------------------------
 
@@ -70,17 +71,162 @@ def jsonl_reduce_io(output_dir, compress = False):
 
 # Map multiprocessing ----------------------------------------------------------------
 
-def pmap(map_fn, data):
+# the time.time() at which this worker process was started, None outside of workers
+worker_started = None
+
+
+def _rss():
+    """the resident set size of this process in bytes, 0 if it is unknown"""
+    try:
+        with open("/proc/self/statm") as r:
+            return int(r.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _work(connection, started, map_fn, initializer, initargs, max_tasks, max_rss):
+    """
+    Maps the batches received until None is received, the output of each item is sent on its own
+    together with whether the worker exits afterwards to be replaced,
+    which it does after max_tasks items or once it takes more than max_rss bytes of memory
+    """
+    global worker_started
+    worker_started = started
+    if initializer is not None: initializer(*initargs)
+
+    tasks = 0
+    while True:
+        batch = connection.recv()
+        if batch is None: return
+
+        for item in batch:
+            output = map_fn(item)
+            tasks += 1
+            recycle = bool(max_tasks and tasks >= max_tasks or max_rss and _rss() > max_rss)
+            connection.send((output, recycle))
+            if recycle: return
+
+
+class _Worker:
+    """A worker process and the items sent to it which are not mapped yet"""
+
+    def __init__(self, start):
+        self.connection, child = mp.Pipe()
+        self.process = mp.Process(target = _work, args = (child, time.time()) + start, daemon = True)
+        self.process.start()
+        child.close()
+        self.items = []
+        # the time at which the worker started to map the first item
+        self.started = None
+
+    def send(self, batch):
+        self.connection.send(batch)
+        self.items = list(batch)
+        self.started = time.monotonic()
+
+    def stop(self, kill = False):
+        if kill or self.items:
+            self.process.kill()
+        else:
+            try:
+                self.connection.send(None)
+            except OSError: pass # the process already exited
+        self.process.join()
+        self.connection.close()
+
+
+def _batches(data, cost, count):
+    """
+    Groups the data into about count batches of similar cost, the most expensive first
+    Data which costs more than a batch is in a batch of its own
+    """
+    costs = [cost(item) for item in data]
+    batch_cost = sum(costs) / count
+
+    batches, batch, current = [], [], 0
+    for i in sorted(range(len(data)), key = costs.__getitem__, reverse = True):
+        if batch and current + costs[i] > batch_cost:
+            batches.append(batch)
+            batch, current = [], 0
+        batch.append(data[i])
+        current += costs[i]
+    if batch: batches.append(batch)
+    return batches
+
+
+def pmap(map_fn, data, initializer = None, initargs = (), processes = None, cost = None,
+         timeout = None, failed = None, max_tasks = None, max_rss = None):
+    """
+    initializer(*initargs) is called once in each worker process before it maps any data
+
+    processes == None: One process per CPU
 
-    cpu_count = mp.cpu_count()
+    cost: estimates how long it takes to map an item, the most expensive items are mapped first,
+          so that no worker is left with a long task at the end
 
-    if cpu_count <= 4: # Too few CPUs for multiprocessing
+    timeout: seconds after which the process mapping an item is killed and replaced
+
+    failed(item, reason): the output for an item whose process was killed or exited, None if failed is None
+
+    max_tasks, max_rss: a worker process is replaced after mapping max_tasks items
+                        or once its resident set size exceeds max_rss bytes
+    """
+
+    data = list(data)
+    processes = processes or mp.cpu_count()
+
+    if processes <= 1 or len(data) <= 1:
         for output in map(map_fn, data):
             yield output
-    else:
-        with ProcessPool(processes = cpu_count) as pool:
-            for output in pool.uimap(map_fn, data, chunksize = 4 * cpu_count):
-                yield output
+        return
+
+    # Each worker takes the next batch once it is done, cheap items are batched to reduce the overhead
+    batches = deque(_batches(data, cost or (lambda item: 1), 4 * processes))
+    start = (map_fn, initializer, initargs, max_tasks, max_rss)
+    workers = [_Worker(start) for _ in range(min(processes, len(batches)))]
+
+    def replace(worker, reason = None):
+        """replaces a worker which exited or is killed, the items it did not map are mapped by another one"""
+        worker.stop(kill = reason is not None)
+        workers.remove(worker)
+        if reason is not None:
+            item = worker.items.pop(0)
+        if worker.items:
+            batches.appendleft(worker.items)
+        if batches:
+            workers.append(_Worker(start))
+        if reason is not None:
+            return failed(item, reason) if failed else None
+
+    try:
+        while True:
+            for worker in workers:
+                if not worker.items and batches: worker.send(batches.popleft())
+            busy = [worker for worker in workers if worker.items]
+            if not busy: break
+
+            wait_time = None
+            if timeout is not None:
+                wait_time = max(0, min(worker.started for worker in busy) + timeout - time.monotonic())
+            ready = mp.connection.wait([worker.connection for worker in busy], wait_time)
+
+            for worker in busy:
+                if worker.connection in ready:
+                    try:
+                        output, recycle = worker.connection.recv()
+                    except EOFError:
+                        worker.process.join()
+                        yield replace(worker, f"the worker process exited with code {worker.process.exitcode}")
+                        continue
+                    worker.items.pop(0)
+                    worker.started = time.monotonic()
+                    if recycle: replace(worker)
+                    yield output
+                elif timeout is not None and time.monotonic() - worker.started > timeout:
+                    yield replace(worker, f"the worker process was killed after {timeout} seconds")
+    finally:
+        for worker in workers:
+            worker.stop()
 
 # Helper ------------------------------------------------------------------
 
@@ -108,7 +254,9 @@ def _reduce_generator(mapped_instance_stream):
 # Map step runs in parrallel / Reduce in single thread
 
 
-def mapreduce(data, map_fn, reducer_fn = None, parallel = False, compress = False, report = False):
+def mapreduce(data, map_fn, reducer_fn = None, parallel = False, compress = False, report = False,
+              initializer = None, initargs = (), processes = None, cost = None,
+              timeout = None, failed = None, max_tasks = None, max_rss = None):
     """
     Map then reduce functions
     Output of map has to be always a collection
@@ -118,9 +266,17 @@ def mapreduce(data, map_fn, reducer_fn = None, parallel = False, compress = Fals
     reducer_fn == file_path: Saves all entries to jsonl into a dir
 
     reducer_fn == callable : Calls reducer with the mapped results
+
+    initializer: called with initargs once in each worker process, if parallel
+
+    processes, cost, timeout, failed, max_tasks, max_rss: see pmap
     """
 
-    mapped_instance_stream = (pmap if parallel else map)(map_fn, data)
+    if parallel:
+        mapped_instance_stream = pmap(map_fn, data, initializer, initargs, processes, cost,
+                                      timeout, failed, max_tasks, max_rss)
+    else:
+        mapped_instance_stream = map(map_fn, data)
 
     if report: mapped_instance_stream = tqdm(mapped_instance_stream, total = len(data))
 
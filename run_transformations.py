@@ -8,16 +8,37 @@ import yaml
 import random
 import traceback
 
+from contextlib import contextmanager
 from glob import glob
 from time import time
 
+import mapreduce as mr
 from mapreduce import mapreduce
 
-from semtransforms import TRANSFORM_NAMES, transform_by_name, _TransformerFN, MIXED_TRANSFORMS
+import semtransforms
+from semtransforms import TRANSFORM_NAMES, transform_by_name, _TransformerFN, MIXED_TRANSFORMS, FindNodes, \
+    preload, start_worker, time_limit, TimeLimitExceeded
+from semtransforms.util.parse_cache import ParseCache
 
 
 # Transformer ---------------------------------------------------------------------------
 
+@contextmanager
+def _replacing(path):
+    """
+    opens a temporary file for writing, which replaces the file at path once it was written completely.
+    An interrupted write neither leaves a partial file behind nor changes an existing one
+    """
+    temp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "w") as w:
+            yield w
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
 class FileTransformer:
 
     def __init__(self, config):
@@ -41,6 +62,9 @@ class FileTransformer:
 
         self._required_transforms = config.required_transforms
         self._pretty_names = config.pretty_names
+        # the preludes of headers are shared by the files even if no folder for the parse cache is given
+        self._parse_cache = ParseCache(config.parse_cache, config.parse_cache_size << 20)
+        self._timeout = config.timeout
 
         try:
             self.git_hash = os.popen('git rev-parse --short head').read().splitlines()[0]
@@ -61,14 +85,48 @@ class FileTransformer:
             source_code = f.read()
 
         start_time = time()
+        # exceptions swallowed by the transformations are counted for each file
+        FindNodes.reset_failures()
 
+        # the checkpoints are generated lazily, each one is written before the next one is generated
+        checkpoints = len(self._num_transforms)
+        output_files = []
+        transform_count = 0
+        full_trace = ''
+        traces = []
         try:
-            if self._trace:
-                # this import does not work if it is at the start of the file.
-                from semtransforms import trace
-                transforms = trace(source_code, '\n'.join(self._trace), self._pretty_names, *self._num_transforms)
-            else:
-                transforms = transform(source_code, pretty_names = self._pretty_names, n = self._num_transforms)
+            with time_limit(self._timeout):
+                if self._trace:
+                    # this import does not work if it is at the start of the file.
+                    from semtransforms import trace
+                    transforms = trace(source_code, '\n'.join(self._trace), self._pretty_names, *self._num_transforms,
+                                       lazy=True, cache=self._parse_cache)
+                else:
+                    transforms = transform(source_code, pretty_names = self._pretty_names, n = self._num_transforms,
+                                           lazy=True, cache=self._parse_cache)
+                for i, (transformed, trace) in enumerate(transforms):
+                    traces.append(trace)
+                    if not trace:
+                        break
+                    transform_count += trace.count('\n') + 1
+                    full_trace = f'{full_trace}\n{trace}' if full_trace else trace
+                    output_files.append(self._write(file_name, i, checkpoints, transformed, trace, transform_count,
+                                                    full_trace))
+                    # the code is dropped before the next checkpoint is generated
+                    del transformed
+                # the traces of checkpoints after an empty one are needed for the required transformations
+                traces += [trace for _, trace in transforms]
+        except TimeLimitExceeded as e:
+            print(f"\nstopped transforming '{file_name}', it {e}.")
+            # the checkpoints written before are complete and kept
+            return [{
+                "source_file": file_name,
+                "output"     : output_files,
+                "exception"  : str(e),
+                "timeout"    : True,
+                "walltime"   : time() - start_time,
+                "swallowed_exceptions": FindNodes.failure_statistics(),
+            }]
         except pycparser.plyparser.ParseError as pe:
             print(f"\ncould not parse '{file_name}' because of {pe}. See statistics for detailed info.")
             return [{
@@ -80,90 +138,93 @@ class FileTransformer:
             traceback.print_exc()
             return [{
                 "source_file": file_name,
+                "output"     : output_files,
                 "exception"  : traceback.format_exc(),
                 "walltime"   : time() - start_time,
+                "swallowed_exceptions": FindNodes.failure_statistics(),
             }]
-        trace = ';'.join(trace for code, trace in transforms)
+        trace = ';'.join(traces)
         for required_transform in self._required_transforms:
             if required_transform not in trace:
                 print(f'Missing {required_transform} in {trace}')
                 return [{
                     "source_file": file_name,
-                    "exception"  : f"missing required transformation '{required_transform}' in '{transforms[-1][1]}'",
+                    "output"     : output_files,
+                    "exception"  : f"missing required transformation '{required_transform}' in '{traces[-1]}'",
                     "walltime"   : time() - start_time,
                 }]
 
-        output_files = []
-        transform_count = 0
-        full_trace = ''
-        for i, (transformed, trace) in enumerate(transforms):
-            if not trace:
-                break
-            transform_count += trace.count('\n') + 1
-            full_trace = f'{full_trace}\n{trace}' if full_trace else trace
-            input_path, ext = os.path.splitext(file_name)
-            basename = os.path.basename(input_path)
-
-            path_parts = [self._output_dir]
-            if self._benchmark_comparison:
-                path_parts.append(str(i))
-            if self._generate_benchmark:
-                path_parts.append(self._prefix + os.path.basename(os.path.dirname(file_name)) + self._suffix)
-            path_parts.append(self._prefix + basename + self._suffix)
-            output_path = os.path.join(*path_parts)
-            if len(transforms) > 1 and not self._benchmark_comparison:
-                output_path += f"-{transform_count}"
-
-            if self._generate_benchmark:
-                with open(input_path + '.yml', 'r') as r:
-                    yml = yaml.safe_load(r)
-                original_files = yml['input_files']
-                yml['input_files'] = os.path.basename(output_path) + ext
-                with open(output_path + '.yml', 'w+') as w:
-                    yaml.dump(yml, w)
-                    w.write(f"\n# original_yaml_file: {os.path.basename(input_path)}.yml"
-                            f"\n# original_input_files: {original_files}\n")
-            
-            with open(output_path + ext, "w") as o:
-                def original_header() -> str:
-                    for file in f'{input_path}{ext}', f'{input_path}.c':
-                        if not os.path.exists(file):
-                            continue
-                        with open(file, 'r') as r:
-                            content = r.read().splitlines()
-                        header = []
-                        while content:
-                            line_content = content[0].lstrip()
-                            if not line_content or line_content.startswith('//'):
-                                header.append(content.pop(0))
-                            elif line_content.startswith('/*'):
-                                while True:
-                                    header.append(content[0])
-                                    if '*/' in content.pop(0): break
-                            else:
-                                break
-                        if any(header):
-                            return '\n'.join(header)
-                    return ''
-                o.write(
-                    self._header
-                        .replace('\\n', '\n').replace('\\r', '\r')
-                        .replace('{input_file}', os.path.basename(input_path) + ext)
-                        .replace('{output_file}', os.path.basename(output_path) + ext)
-                        .replace('{trace}', full_trace.replace(': ', ':').replace('\n', ' '))
-                        .replace('{commit_hash}', self.git_hash)
-                        .replace('{original_header}', original_header())
-                )
-                o.write(transformed)
-            
-            output_files.append({"file_path": output_path + ext, "trace": trace})
-
-        return [{
+        result = {
             "source_file": file_name, 
             "output"     : output_files,
-            "walltime"   : time() - start_time
-        }]
-        
+            "walltime"   : time() - start_time,
+            "swallowed_exceptions": FindNodes.failure_statistics(),
+        }
+        # the startup of a worker process is reported with the first file it transformed
+        if semtransforms.worker_startup is not None:
+            result["worker_startup"] = semtransforms.worker_startup
+            semtransforms.worker_startup = None
+        return [result]
+
+    def _write(self, file_name, i, checkpoints, transformed, trace, transform_count, full_trace):
+        """writes the transformed code of the i-th checkpoint of a file"""
+        input_path, ext = os.path.splitext(file_name)
+        basename = os.path.basename(input_path)
+
+        path_parts = [self._output_dir]
+        if self._benchmark_comparison:
+            path_parts.append(str(i))
+        if self._generate_benchmark:
+            path_parts.append(self._prefix + os.path.basename(os.path.dirname(file_name)) + self._suffix)
+        path_parts.append(self._prefix + basename + self._suffix)
+        output_path = os.path.join(*path_parts)
+        if checkpoints > 1 and not self._benchmark_comparison:
+            output_path += f"-{transform_count}"
+
+        with _replacing(output_path + ext) as o:
+            def original_header() -> str:
+                for file in f'{input_path}{ext}', f'{input_path}.c':
+                    if not os.path.exists(file):
+                        continue
+                    with open(file, 'r') as r:
+                        content = r.read().splitlines()
+                    header = []
+                    while content:
+                        line_content = content[0].lstrip()
+                        if not line_content or line_content.startswith('//'):
+                            header.append(content.pop(0))
+                        elif line_content.startswith('/*'):
+                            while True:
+                                header.append(content[0])
+                                if '*/' in content.pop(0): break
+                        else:
+                            break
+                    if any(header):
+                        return '\n'.join(header)
+                return ''
+            o.write(
+                self._header
+                    .replace('\\n', '\n').replace('\\r', '\r')
+                    .replace('{input_file}', os.path.basename(input_path) + ext)
+                    .replace('{output_file}', os.path.basename(output_path) + ext)
+                    .replace('{trace}', full_trace.replace(': ', ':').replace('\n', ' '))
+                    .replace('{commit_hash}', self.git_hash)
+                    .replace('{original_header}', original_header())
+            )
+            o.write(transformed)
+
+        # the task definition is written once the file it refers to exists
+        if self._generate_benchmark:
+            with open(input_path + '.yml', 'r') as r:
+                yml = yaml.safe_load(r)
+            original_files = yml['input_files']
+            yml['input_files'] = os.path.basename(output_path) + ext
+            with _replacing(output_path + '.yml') as w:
+                yaml.dump(yml, w)
+                w.write(f"\n# original_yaml_file: {os.path.basename(input_path)}.yml"
+                        f"\n# original_input_files: {original_files}\n")
+
+        return {"file_path": output_path + ext, "trace": trace}
 
 
 # Parsing input arguments ----------------------------------------------------------------
@@ -227,13 +288,17 @@ def prepare_parser():
     parser.add_argument("--trace", type = str, default = None, nargs = "+",
                         help = "a trace to reproduce a sequence of transformations")
     parser.add_argument("--recursion_limit", type = int, default = 5000,
-                        help = "limits the recursion depht while traversing the abstract syntax tree")
+                        help = "limits the recursion depth while generating code from and copying the abstract syntax tree")
     parser.add_argument("--prefix", type = str, default = '', help = "prefix for folder and file names")
     parser.add_argument("--suffix", type = str, default = '', help = "suffix for folder and file names")
     parser.add_argument("--header", type = str, default = '', help = "header prefixed to transformed sources files")
     parser.add_argument("--header_file", type = str, default = '', help = "path to header text")
     parser.add_argument("--no_dedup", action = "store_true", help = "prevents overriding of already existing files")
     parser.add_argument("--pretty_names", action = "store_true", help = "creates pretty names which are not obfuscated")
+    parser.add_argument("--parse_cache", type = str, default = None,
+                        help = "folder to store parsed files in, which are loaded instead of parsing them again")
+    parser.add_argument("--parse_cache_size", type = int, default = 1024,
+                        help = "size of the parse cache in MiB, the least recently used files are removed")
 
     for transform_name in TRANSFORM_NAMES:
         help = f"transformation {transform_name}"
@@ -244,6 +309,20 @@ def prepare_parser():
 
     parser.add_argument("--parallel", action = "store_true",
                         help = "makes the transformation of different files run in parallel")
+    parser.add_argument("--processes", type = int, default = None,
+                        help = "number of worker processes with --parallel, defaults to the number of CPUs")
+    parser.add_argument("--timeout", type = float, default = None,
+                        help = "seconds after which the transformation of a file is stopped")
+    # the transformation is usually stopped at once, but not while it is stuck in code which cannot be interrupted
+    parser.add_argument("--kill_delay", type = float, default = 10,
+                        help = "seconds after --timeout after which a worker process which did not stop is killed")
+    parser.add_argument("--max_memory", type = int, default = None,
+                        help = "MiB of address space each worker process may take with --parallel, "
+                               "the transformation of a file which needs more fails")
+    parser.add_argument("--max_tasks_per_worker", type = int, default = None,
+                        help = "number of files after which a worker process is replaced with --parallel")
+    parser.add_argument("--max_worker_memory", type = int, default = None,
+                        help = "MiB of resident memory above which a worker process is replaced with --parallel")
     parser.add_argument("--generate_benchmark", action = "store_true",
                         help = "keeps the folder structure of the original and copies .yml files")
     parser.add_argument("--benchmark_comparison", action = "store_true",
@@ -276,9 +355,6 @@ def main(*args):
     if args.no_dedup:
         input_files = dedup_input_files(args, input_files)
 
-    # Guarantees that files of similar complexity are batched together
-    input_files = sorted(input_files, key = lambda path: os.stat(path).st_size)
-
     print(f"Found {len(input_files)} files...\n"
           f"Start transformation...")
     
@@ -294,8 +370,23 @@ def main(*args):
             else:
                 copy_info_files(folder, os.path.join(args.output_dir, basename))
 
+    if args.parallel:
+        # the worker processes are forked after everything is loaded, thus they share it
+        preload()
+
+    def failed(file_name, reason):
+        print(f"\ncould not transform '{file_name}', {reason}.")
+        return [{"source_file": file_name, "exception": reason}]
+
     # Run mapreduce
-    mapreduce(input_files, transformer, reducer_fn = args.output_dir, parallel = args.parallel, report = True)
+    # the largest files are transformed first, thus the run does not end with one worker transforming a large file
+    max_memory = None if args.max_memory is None else args.max_memory << 20
+    mapreduce(input_files, transformer, reducer_fn = args.output_dir, parallel = args.parallel, report = True,
+              initializer = lambda: start_worker(mr.worker_started, max_memory), processes = args.processes,
+              cost = lambda path: os.stat(path).st_size,
+              timeout = None if args.timeout is None else args.timeout + args.kill_delay, failed = failed,
+              max_tasks = args.max_tasks_per_worker,
+              max_rss = None if args.max_worker_memory is None else args.max_worker_memory << 20)
 
 
 if __name__ == '__main__':
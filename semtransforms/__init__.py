@@ -8,19 +8,25 @@ Python package for semantic-equivalent C transforms
 # A transform is a function that transforms C-code (string) into C-code (string)
 
 # A GLOBAL list of all available transforms
-import _thread
+import contextlib
+import ctypes
 import gc
 from pycparser.plyparser import ParseError
 from pathos.pools import ProcessPool
 import os.path
 import random
 import shutil
+import signal
 import threading
+import time
 
 from semtransforms import util
+from semtransforms.context import seed_identifiers
 from semtransforms.framework import Transformer
+from semtransforms.index import TransformIndex
 from semtransforms.pretransformation import support_extensions
 from semtransforms.transformation import FindNodes
+from semtransforms.util.parse_cache import ParseCache, _prelude_parser
 # importing subclasses of FindNodes, which are not directly called
 from semtransforms.transformations import *
 
@@ -34,10 +40,10 @@ class _TransformerFN:
         self._transformer = Transformer(*transforms)
         self._numbers     = numbers
     
-    def __call__(self, source_code, pretty_names, n=None):
+    def __call__(self, source_code, pretty_names, n=None, lazy=False, cache=None):
         if n is None: n = self._numbers
         if isinstance(n, int): n = (n,)
-        return transform(source_code, self._transformer, pretty_names, *n)
+        return transform(source_code, self._transformer, pretty_names, *n, lazy=lazy, cache=cache)
 
 
 def _build(*trans, number=(10,)):
@@ -210,56 +216,120 @@ def transform_by_name(name, pretty_names=True):
     return lambda x: transform(x, Transformer(FindNodes.all[name]), pretty_names)
 
 
+# seconds it took to start this worker process, None if it was not started by start_worker or was reported already
+worker_startup = None
+
+
+def preload():
+    """
+    builds everything which would otherwise be built by the first transformation.
+    Called before worker processes are forked, the workers share it instead of building it themselves.
+    """
+    _prelude_parser()
+    # the preloaded objects are never collected, thus the collector does not copy their pages in the workers
+    gc.freeze()
+
+
+def start_worker(started: float, max_memory: int = None):
+    """initializes a worker process started at the given time.time(), which may take max_memory bytes of address space"""
+    global worker_startup
+    if max_memory is not None:
+        import resource
+        # a file which needs more memory fails with a MemoryError, the process which collects the results is not limited
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    preload()
+    # forked workers start with the same random state, thus they would all choose the same transformations
+    random.seed()
+    worker_startup = time.time() - started
+
+
 def all_transformer():
     return Transformer(*FindNodes.all.values())
 
 
-def transform(program, transformer, pretty_names, *number):
+def transform(program, transformer, pretty_names, *number, lazy=False, cache=None):
+    """transforms the program, a result is returned for each number, see on_ast"""
     if len(number) >= 1:
         splits = [number[0]] + [number[i + 1] - number[i] for i in range(len(number) - 1)]
     else:
         splits = [1]
 
     def part_fn(split):
-        return lambda ast: transformer.transform(ast, split, pretty_names)
+        # nothing else changes the AST between the operations
+        return lambda ast: transformer.transform(ast, split, pretty_names, verify=False)
 
-    return support_extensions(program, lambda x: on_ast(x, *[part_fn(split) for split in splits]))
+    operations = [part_fn(split) for split in splits]
+    return support_extensions(program, lambda x: (iter_on_ast if lazy else on_ast)(x, *operations, cache=cache,
+                                                                                    indexed=True))
 
 
-def trace(program, trace, pretty_names=True, *number):
+def trace(program, trace, pretty_names=True, *number, lazy=False, cache=None):
     parts = trace.split('\n')
     splits = [(0, number[0])] + [(number[i], number[i + 1]) for i in range(len(number) - 1)]
     parts = ['\n'.join(parts[start:end]) for start, end in splits]
-    return support_extensions(program, lambda x: on_ast(x, *[(lambda ast: _trace(ast, part, pretty_names=pretty_names))
-                                                             for part in parts]))
 
+    def part_fn(part):
+        return lambda ast: _trace(ast, part, pretty_names=pretty_names, verify=False)
 
-def add_empty_lists(ast: Node):
-    match ast:
-        case Case(stmts=None) | Default(stmts=None) as case:
-            case.stmts = []
-        case Compound(block_items=None) as compound:
-            compound.block_items = []
-    for c in ast:
-        add_empty_lists(c)
+    operations = [part_fn(part) for part in parts]
+    return support_extensions(program, lambda x: (iter_on_ast if lazy else on_ast)(x, *operations, cache=cache,
+                                                                                    indexed=True))
 
 
-def on_ast(program, *operations):
-    ast = util.parse(program)
-    add_empty_lists(ast)
-    results = []
+def add_empty_lists(ast: Node):
+    for node in util.preorder(ast):
+        match node:
+            case Case(stmts=None) | Default(stmts=None) as case:
+                case.stmts = []
+            case Compound(block_items=None) as compound:
+                compound.block_items = []
+
+
+def parse_program(program, cache: ParseCache = None):
+    """
+    parses the program and adds empty lists.
+    If a cache is given, the AST is loaded from and stored in it and the prelude of headers is only parsed once.
+    """
+    ast = cache.load(program) if cache is not None else None
+    if ast is None:
+        ast = util.parse(program) if cache is None else cache.parse(program)
+        add_empty_lists(ast)
+        if cache is not None:
+            cache.store(program, ast)
+    return ast
+
+
+def on_ast(program, *operations, cache: ParseCache = None, indexed=False):
+    """
+    parses the program and applies the operations to its AST, returns the code and result after each operation.
+    indexed: the operations only change the AST with its TransformIndex,
+    thus the code of the top level nodes they did not change is reused
+    """
+    return list(iter_on_ast(program, *operations, cache=cache, indexed=indexed))
+
+
+def iter_on_ast(program, *operations, cache: ParseCache = None, indexed=False):
+    """
+    like on_ast, but the code after an operation is only generated once it is requested,
+    thus only one version of the code has to be kept in memory at once
+    """
+    ast = parse_program(program, cache)
 
     for op in operations:
         result = op(ast)
-        results.append((util.generate(ast), result))
-
-    return results
+        yield TransformIndex.generate(ast) if indexed else util.generate(ast), result
 
 
-def _trace(ast: Node, run: str, pretty_names=True):
+def _trace(ast: Node, run: str, pretty_names=True, verify=True):
+    # the indices of a trace are the ones of the TransformIndex, which may contain transforms which are not valid
+    if not pretty_names:
+        seed_identifiers(random.getrandbits(64))
+    index = TransformIndex.of(ast, pretty_names, verify=verify)
     for line in run.split("\n"):
-        name, index = line.split(":")
-        FindNodes.all[name.strip()].all_transforms(ast, pretty_names=pretty_names)[int(index.strip())]()
+        name, transform_index = line.split(":")
+        transform = FindNodes.all[name.strip()]
+        index.all_transforms([transform])
+        index.apply(transform, int(transform_index.strip()))
     return run
 
 
@@ -278,17 +348,57 @@ def task(name: str, program: str, pretty_names: bool = True, *number: int, f="/*
                                  pretty_names, *number))
 
 
-def limit(task, timeout=100):
-    if timeout < 0:
-        return task()
-    timer = threading.Timer(timeout, lambda: _thread.interrupt_main())
-    timer.start()
+class TimeLimitExceeded(BaseException):
+    """raised by time_limit, it is no Exception, thus it is not swallowed by the transformations"""
+
+
+@contextlib.contextmanager
+def time_limit(timeout):
+    """
+    raises TimeLimitExceeded in the code run inside once it takes more than timeout seconds, a negative timeout or None
+    does not limit it. Outside of the main thread or without SIGALRM a timer thread raises it asynchronously instead,
+    which only happens between two bytecodes, thus not while a call into C code runs.
+    """
+    if timeout is None or timeout < 0:
+        yield
+        return
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, "setitimer"):
+        ident = threading.get_ident()
+        lock = threading.Lock()
+        running = [True]
+
+        def exceeded_async():
+            with lock:
+                if running[0]:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident),
+                                                               ctypes.py_object(TimeLimitExceeded))
+
+        timer = threading.Timer(timeout, exceeded_async)
+        timer.start()
+        try:
+            yield
+        finally:
+            with lock:
+                running[0] = False
+            timer.cancel()
+        return
+
+    def exceeded(signum, frame):
+        raise TimeLimitExceeded(f"exceeded the time limit of {timeout} seconds")
+
+    # a timer thread cannot interrupt the main thread of a worker process, a signal can
+    previous = signal.signal(signal.SIGALRM, exceeded)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
     try:
-        result = task()
-        timer.cancel()
-        return result
+        yield
     finally:
-        timer.cancel()
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def limit(task, timeout=100):
+    with time_limit(timeout):
+        return task()
 
 
 def trans(root, base_len, output, file, task_name, recursion_limit, *number, timeout=-1):
@@ -1,22 +1,31 @@
 import itertools
 import random
 import typing
-from functools import cache
 
 from pycparser.c_ast import *
 
-from semtransforms.util import NoNode
+from semtransforms.util import NoNode, ParentChain, preorder
 from semtransforms.util.types import typecast
 
 _beginnings = "abcdefghijklmnopqrstuvwkyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 _letters = _beginnings + "0123456789"
 
 
+# the identifiers are drawn from their own generator, thus the transformations which are chosen do not depend on
+# how many names were created while searching, which depends on the candidates which were searched again
+_identifiers = random.Random()
+
+
+def seed_identifiers(seed):
+    """seeds the generator of random_identifier"""
+    _identifiers.seed(seed)
+
+
 def random_identifier(length: int = 8) -> str:
     """random identifier"""
-    result = random.choice(_beginnings)
+    result = _identifiers.choice(_beginnings)
     for i in range(length - 1):
-        result += random.choice(_letters)
+        result += _identifiers.choice(_letters)
     return result
 
 
@@ -36,7 +45,7 @@ def next_identifier(name: str) -> str:
 
 
 def coords(ast):
-    return [ast.coord] + [coord for child in ast for coord in coords(child)]
+    return [node.coord for node in preorder(ast)]
 
 
 def lines(ast):
@@ -95,11 +104,140 @@ def _no_decl_type(type: Node):
     return type.type.type if isinstance(type.type, TypeDecl) else type.type
 
 
+_SCOPES = (Compound, While, DoWhile, If, Switch, For)
+
+
+class _Scan:
+    """identifiers declared directly in a scope, changes of labels and function definitions are kept in order"""
+    __slots__ = ("future", "ops")
+
+    LABELS_OF = 0
+    LABEL = 1
+    FUNC_DEF = 2
+
+    def __init__(self, root: Node):
+        self.future = ContextLevelTime()
+        self.ops: typing.List[typing.Tuple[int, str, Node]] = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.__class__ in _SCOPES and node is not root:
+                self.ops.append((_Scan.LABELS_OF, "", node))
+                continue  # stop because a new scope is created
+            # add identifiers to the future
+            if isinstance(node, Label):
+                self.ops.append((_Scan.LABEL, node.name, node))
+            if isinstance(node, FuncDef):
+                self.ops.append((_Scan.FUNC_DEF, node.decl.name, node))
+            name, map = ContextVisitor._name_and_map(node, self.future)
+            if name:
+                map[name] = node
+                continue
+            childs = [child for child in node if child]
+            childs.reverse()
+            stack += childs
+
+
+class Scopes:
+    """
+    The scopes of an AST, each scope is only scanned once for the identifiers declared in it.
+    The lines of nodes used for names, the types of expressions and the fields of structs are kept as well.
+    The scans are kept until they are invalidated, thus modified nodes have to be invalidated.
+    The types of expressions additionally depend on the declarations they use.
+    """
+    def __init__(self):
+        self._scans: typing.Dict[Node, _Scan] = {}
+        self._labels: typing.Dict[Node, typing.Dict[str, Node]] = {}
+        self._lines: typing.Dict[Node, typing.Optional[typing.Tuple[int, int]]] = {}
+        # types of an expression for each name the types were created with
+        self._types: typing.Dict[Node, typing.Dict[typing.Optional[str], typing.Set[Node]]] = {}
+        self._fields: typing.Dict[Node, typing.Dict[str, Node]] = {}
+
+    def scan(self, root: Node) -> _Scan:
+        scan = self._scans.get(root)
+        if scan is None:
+            scan = self._scans[root] = _Scan(root)
+        return scan
+
+    def labels(self, node: Node) -> typing.Dict[str, Node]:
+        """returns all labels in a node, labels inside of labels are not found"""
+        labels = self._labels.get(node)
+        if labels is None:
+            labels = self._labels[node] = {n.name: n for n in preorder(node, lambda n: n.__class__ is Label)
+                                           if n.__class__ is Label}
+        return dict(labels)
+
+    def lines(self, node: Node) -> typing.Optional[typing.Tuple[int, int]]:
+        """returns the first and last line of a node and its descendants, None if no line is known"""
+        lines = self._lines
+        if node in lines:
+            return lines[node]
+        # a node is added a second time once the lines of all of its childs are known
+        stack = [(node, False)]
+        while stack:
+            current, childs_known = stack.pop()
+            if childs_known:
+                first = last = current.coord.line if current.coord else None
+                for child in current:
+                    child_lines = lines[child]
+                    if child_lines and (first is None or child_lines[0] < first):
+                        first = child_lines[0]
+                    if child_lines and (last is None or child_lines[1] > last):
+                        last = child_lines[1]
+                lines[current] = None if first is None else (first, last)
+            elif current not in lines:
+                stack.append((current, True))
+                stack += [(child, False) for child in current if child not in lines]
+        return lines[node]
+
+    def types(self, node: Node) -> typing.Dict[typing.Optional[str], typing.Set[Node]]:
+        """returns the known types of an expression for each name, they can be added to the result"""
+        types = self._types.get(node)
+        if types is None:
+            types = self._types[node] = {}
+        return types
+
+    def fields(self, struct: Node) -> typing.Dict[str, Node]:
+        """returns the first declaration of each field of a struct by its name"""
+        fields = self._fields.get(struct)
+        if fields is None:
+            fields = {}
+            for decl in struct.decls:
+                fields.setdefault(decl.name, decl)
+            self._fields[struct] = fields
+        return fields
+
+    def invalidate(self, node: Node, parents: typing.Iterable[Node] = ()):
+        """forgets the scans, lines and types of a node, its descendants and its parents"""
+        for n in itertools.chain(preorder(node), parents):
+            self._scans.pop(n, None)
+            self._labels.pop(n, None)
+            self._lines.pop(n, None)
+            self._types.pop(n, None)
+            self._fields.pop(n, None)
+
+    def forget_types(self):
+        """forgets the types of all expressions, used when declarations which are visible everywhere changed"""
+        self._types.clear()
+        self._fields.clear()
+
+    def clear(self):
+        self._scans.clear()
+        self._labels.clear()
+        self._lines.clear()
+        self.forget_types()
+
+
 class ContextVisitor:
     """visits the childs of a node with a valid ContextVisitor"""
-    def __init__(self, node: Node, visit_node, transformation_name, pretty_names):
+    # scopes shared by all visitors while the AST does not change, otherwise each visitor scans the scopes itself
+    scopes: typing.Optional[Scopes] = None
+
+    def __init__(self, node: Node, visit_node, transformation_name, pretty_names, visit: bool = True):
         """visit_node has to be callable with:
-        (visitor: ContextVisitor, current: Node, parents: typing.List[Node], index: int)"""
+        (visitor: ContextVisitor, current: Node, parents: typing.List[Node], index: int)
+        if visit is False, only the context of node is built and the caller is responsible for visiting it"""
+        self._scopes = ContextVisitor.scopes
         self._types = {}
         self.labels = {}
         self.func_defs = {}
@@ -115,121 +253,171 @@ class ContextVisitor:
         self.transformation_name = transformation_name
         self.pretty_names = pretty_names
         # run
-        self._visit(node, [])
-        self._build_labels.cache_clear()
-
-    def _visit(self, current: Node, parents: typing.List[Node] = [], index: int = 0):
-        """visit a Node and its child while adding variable names to the past once they are declared"""
+        if visit:
+            self._visit(node, ParentChain())
+
+    def _tables(self) -> "Scopes":
+        """the scopes of the search of this visitor, they are not kept once the search has ended and the AST may change"""
+        if self._scopes is not None and ContextVisitor.scopes is self._scopes:
+            return self._scopes
+        return Scopes()
+
+    @property
+    def labels(self) -> typing.Dict[str, Node]:
+        """labels of the scope which was built last, they are only searched once they are needed"""
+        if self._labels_of is not None:
+            self._labels = self._tables().labels(self._labels_of)
+            self._labels_of = None
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels: typing.Dict[str, Node]):
+        self._labels = labels
+        self._labels_of = None
+
+    def _visit(self, current: Node, parents: ParentChain = ParentChain(), index: int = 0):
+        """
+        visit a Node and its child while adding variable names to the past once they are declared.
+        The nodes are visited with an explicit stack of tasks, a task is a function with its arguments.
+        Tasks without function visit the node in their arguments.
+        """
+        tasks = self._tasks = [(None, (current, parents, index))]
+        visits, default = ContextVisitor._VISITS, ContextVisitor._visit_default
+        while tasks:
+            task, args = tasks.pop()
+            if task is None:
+                # visit a node, this is the most common task
+                current = self.current = args[0]
+                visits.get(current.__class__, default)(self, *args)
+            else:
+                task(*args)
+
+    def _visit_later(self, *tasks):
+        """adds tasks which are executed in the given order before all tasks which were added before"""
+        self._tasks += reversed(tasks)
+
+    def _visit_scope(self, current: Node, parents: ParentChain, index: int):
+        # These are a scope, a new ContextLevel has to be temporarily created
+        self._build_context(current)
+        self.visit_node(self, current, parents, index)
+        parents = parents.push(current)
+        childs = [(None, (child, parents, i)) for i, child in enumerate(current)]
+        self._visit_later(*childs,
+                          (self.visit_node, (self, NoNode(), parents, len(childs))),
+                          (self._leave_scope, ()))
+
+    def _leave_scope(self):
+        del self.levels[-1]
+
+    def _visit_for(self, current: For, parents: ParentChain, index: int):
+        # This is 2 scopes, new Contextlevel have to be temporarily created
+        tasks = []
+        i = 0
+        if current.init:
+            self._build_context(current.init)
+            tasks.append((None, (current.init, parents.push(current), i)))
+            i += 1
+        self._visit_later(*tasks, (self._visit_for_loop, (current, parents, index, i)))
+
+    def _visit_for_loop(self, current: For, parents: ParentChain, index: int, i: int):
         self.current = current
-        match current:
-            case Compound() | While() | DoWhile() | If() | Switch():
-                # These are a scope, a new ContextLevel has to be temporarily created
-                self._build_context(current)
-                self.visit_node(self, current, parents, index)
-                parents = [] + parents + [current]
-                i = 0
-                for child in current:
-                    self._visit(child, parents, i)
-                    i += 1
-                self.visit_node(self, NoNode(), parents, i)
-                del self.levels[-1]
-            case For(init=init, cond=cond, next=next, stmt=stmt):
-                # This is 2 scopes, new Contextlevel have to be temporarily created
-                i = 0
-                if init:
-                    self._build_context(init)
-                    self._visit(init, parents + [current], i)
-                    i += 1
-
-                self.current = current
-                self.visit_node(self, current, parents, index)
-                parents = [] + parents + [current]
-                
-                for child in cond, next:
-                    if child:
-                        self._visit(child, parents, i)
-                    i += 1
-                self._build_context(stmt)
-                self._visit(stmt, parents, i)
-                if init:
-                    del self.levels[-1]
-                del self.levels[-1]
-            case FuncDef(decl=Decl(name=name, type=func_type) as decl, body=body):
-                # Function definition are always global
-                self.globals.add(name)
-
-                # This a scope with parameters as variables, a new ContextLevel has to be temporarily created
-                self.visit_node(self, current, parents, index)
-                parents = [] + parents + [current]
-                self._build_context(func_type)
-                self._visit(decl, parents, 0)
-                if name in self.levels[-2].future.default:
-                    self.levels[-2].past.default[name] = self.levels[-2].future.default[name]
-                    del self.levels[-2].future.default[name]
-                self._visit(body, parents, 1)
-                del self.levels[-1]
-            case Typedef(name=name, type=def_type):
-                # Type definition are always global
+        self.visit_node(self, current, parents, index)
+        parents = parents.push(current)
+        tasks = []
+        for child in current.cond, current.next:
+            if child:
+                tasks.append((None, (child, parents, i)))
+            i += 1
+        tasks.append((self._build_context, (current.stmt,)))
+        tasks.append((None, (current.stmt, parents, i)))
+        if current.init:
+            tasks.append((self._leave_scope, ()))
+        self._visit_later(*tasks, (self._leave_scope, ()))
+
+    def _visit_func_def(self, current: FuncDef, parents: ParentChain, index: int):
+        # Function definition are always global
+        self.globals.add(current.decl.name)
+
+        # This a scope with parameters as variables, a new ContextLevel has to be temporarily created
+        self.visit_node(self, current, parents, index)
+        parents = parents.push(current)
+        self._build_context(current.decl.type)
+        self._visit_later((None, (current.decl, parents, 0)),
+                          (self._visit_func_body, (current, parents)),
+                          (self._leave_scope, ()))
+
+    def _visit_func_body(self, current: FuncDef, parents: ParentChain):
+        name = current.decl.name
+        if name in self.levels[-2].future.default:
+            self.levels[-2].past.default[name] = self.levels[-2].future.default[name]
+            del self.levels[-2].future.default[name]
+        self._visit_later((None, (current.body, parents, 1)))
+
+    def _visit_typedef(self, current: Typedef, parents: ParentChain, index: int):
+        # Type definition are always global
+        name, def_type = current.name, current.type
+        self.globals.add(name)
+
+        # a typedef is declared and has to be added to the past
+        self.visit_node(self, current, parents, index)
+        self.levels[-1].past.default[name] = self._value(def_type.type if isinstance(def_type, TypeDecl) else def_type)
+        del self.levels[-1].future.default[name]
+
+    def _visit_default(self, current: Node, parents: ParentChain, index: int):
+        # default: visit node and childs
+        declaration = current.__class__ in (Decl, Enumerator)
+        if current.__class__ is Decl and isinstance(current.type, FuncDecl) and current.name not in self.func_defs:
+            self.func_defs[current.name] = current
+
+        self.visit_node(self, current, parents, index)
+        childs = list(current)
+        # only declarations can change the context after their childs are visited
+        if childs or declaration:
+            parents = parents.push(current)
+            if declaration:
+                self._tasks.append((self._declared, (current, parents)))
+            self._tasks += [(None, (childs[i], parents, i)) for i in range(len(childs) - 1, -1, -1)]
+
+    def _declared(self, current: Node, parents: ParentChain):
+        # check if a identifier is declared and has to be added to the past
+        name, future = self._name_and_map(current, self.levels[-1].future)
+        if name:
+            if not any(isinstance(p, (FuncDecl, FuncDef, Compound)) for p in reversed(parents)):
                 self.globals.add(name)
 
-                # a typedef is declared and has to be added to the past
-                self.visit_node(self, current, parents, index)
-                self.levels[-1].past.default[name] = self._value(def_type.type if isinstance(def_type, TypeDecl) else def_type)
-                del self.levels[-1].future.default[name]
-            case _:
-                # default: visit node and childs
-                if isinstance(current, Decl) and isinstance(current.type, FuncDecl) and current.name not in self.func_defs:
-                    self.func_defs[current.name] = current
-
-                self.visit_node(self, current, parents, index)
-                parents = [] + parents + [current]
-                i = 0
-                for child in current:
-                    self._visit(child, parents, i)
-                    i += 1
-                # check if a identifier is declared and has to be added to the past
-                name, future = self._name_and_map(current, self.levels[-1].future)
-                if name:
-                    if not any(isinstance(p, (FuncDecl, FuncDef, Compound)) for p in parents):
-                        self.globals.add(name)
-                    
-                    _, past = self._name_and_map(current, self.levels[-1].past)
-                    if name in future:
-                        past[name] = future[name]
-                        del future[name]
-
-    def _build_context(self, current: Node, first=True):
+            _, past = self._name_and_map(current, self.levels[-1].past)
+            if name in future:
+                past[name] = future[name]
+                del future[name]
+
+    # how the nodes of a class are visited, all other nodes are visited with _visit_default
+    _VISITS = {
+        Compound: _visit_scope,
+        While: _visit_scope,
+        DoWhile: _visit_scope,
+        If: _visit_scope,
+        Switch: _visit_scope,
+        For: _visit_for,
+        FuncDef: _visit_func_def,
+        Typedef: _visit_typedef,
+    }
+
+    def _build_context(self, current: Node):
         """creates a ContextLevel with all identifiers directly in this scope in the future"""
         assert current is not None
-        if current.__class__ in (Compound, While, DoWhile, If, Switch, For) and not first:
-            self.labels = self._build_labels(current)
-            return  # stop because a new scope is created
-        if first:
-            self.levels += [ContextLevel(current)]
-        # add identifiers to the future
-        if isinstance(current, Label):
-            self.labels[current.name] = current
-        if isinstance(current, FuncDef):
-            self.func_defs[current.decl.name] = current
-        name, map = self._name_and_map(current, self.levels[-1].future)
-        if name:
-            map[name] = current
-            return
-        # run recursively
-        for child in current:
-            if child:
-                self._build_context(child, False)
-
-    @cache
-    def _build_labels(self, current: Node) -> typing.Dict[str, Node]:
-        if current.__class__ is Label:
-            return {current.name: current}
-        result = {}
-        for child in current:
-            if child:
-                result.update(self._build_labels(child))
-        return result
-
+        scan = self._tables().scan(current)
+        level = ContextLevel(current)
+        level.future.default = dict(scan.future.default)
+        level.future.enums = dict(scan.future.enums)
+        level.future.structs = dict(scan.future.structs)
+        self.levels += [level]
+        for op, name, node in scan.ops:
+            if op == _Scan.LABELS_OF:
+                self._labels_of = node
+            elif op == _Scan.LABEL:
+                self.labels[name] = node
+            else:
+                self.func_defs[name] = node
 
     @staticmethod
     def _name_and_map(node: Node, clt: ContextLevelTime) -> typing.Tuple[str, typing.Dict[str, Node]]:
@@ -257,12 +445,13 @@ class ContextVisitor:
             result |= getattr(getattr(level, time), type)
         return result
 
-    def value(self, name: str, type="default") -> typing.Optional[Decl]:
-        """returns the value of the declaration for a name"""
+    def value(self, name: str, type="default", default=None) -> typing.Optional[Decl]:
+        """returns the value of the declaration for a name, or default if it is not declared"""
         for level in reversed(self.levels):
-            if name in getattr(level.past, type):
-                return getattr(level.past, type)[name]
-        return None
+            values = getattr(level.past, type)
+            if name in values:
+                return values[name]
+        return default
 
     def _value(self, node: Node):
         """returns the value of the declaration for a node"""
@@ -276,31 +465,34 @@ class ContextVisitor:
 
     def free_name(self, type="default", prefix = "", used_names=None):
         """creates a free name which can be inserted into a program"""
+        # the maps of used names are only searched for the tried names instead of being merged
         if type == "label":
-            all_keys = self.labels
+            used = [self.labels]
         else:
-            all_keys = set([key for level in self.levels for key in getattr(level.past, type).keys()])
-            all_keys |= set([key for key in getattr(self.levels[-1].future, type).keys()])
+            used = [getattr(level.past, type) for level in self.levels] + [getattr(self.levels[-1].future, type)]
             if type == 'default':
-                all_keys |= set([key for key in self.func_defs.keys()])
+                used.append(self.func_defs)
         if used_names:
-            all_keys |= set(used_names)
+            used.append(set(used_names))
+
+        def is_used(name: str) -> bool:
+            return any(name in names for names in used)
+
         if self.pretty_names:
             i = 0
             basename = f'{prefix}{self.transformation_name}_'
-            l = lines(self.current)
+            l = self._tables().lines(self.current)
             if l:
                 basename += f'line_{l[0]}_to_{l[1]}_'
             name = f'{basename}{i}'
-            while name in all_keys:
+            while is_used(name):
                 i += 1
                 name = f'{basename}{i}'
             return name
         else:
             name = random_identifier()
-            while prefix + name in all_keys:
+            while is_used(prefix + name):
                 name = next_identifier(name)
-            print(prefix + name)
             return prefix + name
 
     def basic_type(self, node: Node) -> typing.Optional[str]:
@@ -316,13 +508,16 @@ class ContextVisitor:
         return type.names[0]
 
     def type(self, node: Node, name: str = None) -> typing.Set[Node]:
-        """returns the possible types of a node"""
-        if node in self._types:
-            return self._types[node]
+        """returns the possible types of a node, while searching they are kept for all visitors"""
         if name is None and hasattr(node, "name"):
             name = node.name
-        result = self._type(node, name)
-        self._types[node] = result
+        if self._scopes is not None and ContextVisitor.scopes is self._scopes:
+            types = self._scopes.types(node)
+        else:
+            types = self._types.setdefault(node, {})
+        result = types.get(name)
+        if result is None:
+            result = types[name] = self._type(node, name)
         return result
 
     def _type(self, node: Node, name: str) -> typing.Set[Node]:
@@ -334,9 +529,8 @@ class ContextVisitor:
             decl_type = decl_value.type
             if isinstance(decl_type, TypeDecl):
                 return None
-            
-            decls = decl_type.decls
-            return [d for d in decls if d.name == field_name][0]
+
+            return self._tables().fields(decl_type)[field_name]
 
         match node:
             # may only be used if there is no declaration between the current statement and node
@@ -366,7 +560,8 @@ class ContextVisitor:
                 type = self.type(expr, name)
                 if len(type) == 1 and {t.__class__ for t in type} == {PtrDecl}:
                     return {_no_decl_type(t) for t in type}
-                raise NotImplementedError(f"Pointers ({node.__repr__()}) need to have ONE well-defined type")
+                # pointers need to have ONE well-defined type, otherwise the type is unknown
+                return set()
             case UnaryOp(expr=expr):
                 return self.type(expr, name)
 
@@ -385,7 +580,24 @@ class ContextVisitor:
         result = set()
         for types in itertools.product(self.type(node1, name), self.type(node2, name)):
             if any(t == "UNDEFINED" for t in types): continue
+            if types[0].__class__ is not IdentifierType or types[1].__class__ is not IdentifierType:
+                # pointers, arrays and structs are not cast, thus the type is unknown
+                return set()
             result |= typecast(types[0].names[0], types[1].names[0])
         return result
 
 
+class ContextView(ContextVisitor):
+    """the context of one transformation while sharing the traversal of a ContextVisitor with other transformations"""
+    def __init__(self, visitor: ContextVisitor, transformation_name):
+        self.visitor = visitor
+        self.transformation_name = transformation_name
+        # types are cached together with the name they were built for, thus they are not shared
+        self._types = {}
+
+    @property
+    def labels(self) -> typing.Dict[str, Node]:
+        return self.visitor.labels
+
+    def __getattr__(self, name):
+        return getattr(self.visitor, name)
@@ -3,6 +3,8 @@ from typing import Tuple, Union
 
 from pycparser.c_ast import Node
 
+from semtransforms.context import seed_identifiers
+from semtransforms.index import TransformIndex
 from semtransforms.transformation import FindNodes
 
 
@@ -33,24 +35,50 @@ class Transformer:
     def probability(possibility: Tuple, run: int) -> float:
         return max(0, possibility[1](run)) if callable(possibility[1]) else possibility[1]
 
-    def transform(self, ast: Node, repetitions=1, pretty_names=True):
-        """do any number of transformations on the ast with the given probabilities"""
+    def transform(self, ast: Node, repetitions=1, pretty_names=True, verify=True):
+        """
+        do any number of transformations on the ast with the given probabilities.
+        verify=False: the ast was only changed by its TransformIndex since the index was created or verified
+        """
         trace = ""
+        if not pretty_names:
+            # the names are random too, they are the same for the same seed of random
+            seed_identifiers(random.getrandbits(64))
+        index = TransformIndex.of(ast, pretty_names, verify)
         for i in range(repetitions):
             # calculate probabilities where necessary and keep only those > 0
             possibilities = list(filter(lambda t: t[1] > 0, map(lambda t: (t[0], self.probability(t, i)), self.trans)))
-            # find a random choice from possibilities with at least one possible configuration
-            transforms = None
-            while not transforms:
+            # find a random choice from possibilities with at least one valid configuration
+            transform_index = None
+            while transform_index is None:
                 if not possibilities:
                     return trace[:-1] if trace else ""
                 choice = self.transform_selector(*zip(*possibilities))[0]
-                transforms = choice.all_transforms(ast, pretty_names=pretty_names)
+                # the index only searches the top level nodes changed since this transformation was last searched
+                transforms = index.all_transforms([choice])[choice]
                 possibilities = list(filter(lambda p: p[0] != choice, possibilities))
 
+                # the index is chosen instead of the transform, so that only the chosen transform is created.
+                # Deferred transforms are only validated once they are chosen, invalid ones are chosen from again
+                candidates = range(len(transforms))
+                # positions of the candidates which were moved, all others are at the position of their value
+                positions = {}
+                while candidates:
+                    transform_index = self.config_selector(candidates)
+                    if index.validate(choice, transform_index):
+                        break
+                    # the invalid candidate is replaced by the last one, thus it is removed in constant time
+                    if candidates.__class__ is range:
+                        candidates = list(candidates)
+                    position = positions.pop(transform_index, transform_index)
+                    last = candidates.pop()
+                    if last != transform_index:
+                        candidates[position] = last
+                        positions[last] = position
+                    transform_index = None
+
             # Loop is run at least run once because random_number >= 0, thus choice is always initialized
             # noinspection PyUnboundLocalVariable
-            transform = self.config_selector(transforms)
-            trace += f"{choice.func.__name__}: {transforms.index(transform)}\n"
-            transform()
+            trace += f"{choice.func.__name__}: {transform_index}\n"
+            index.apply(choice, transform_index)
         return trace[:-1] if trace else ""
\ No newline at end of file
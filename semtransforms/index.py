@@ -0,0 +1,400 @@
+import bisect
+import typing
+import weakref
+from typing import Dict, List
+
+from pycparser import c_ast
+from pycparser.c_ast import Node
+
+from semtransforms.context import ContextVisitor, ContextView, Scopes
+from semtransforms.util import ParentChain, generate, generate_top_level
+from semtransforms.util.properties import NodeProperties
+from semtransforms.transformation import Bindings, Deferred, FindNodes, Transforms, add_necessities, decl_first, \
+    search_tables, _collect_transforms
+
+
+class _Recording:
+    """records changes of a dict or set of a ContextVisitor into the log of the current top level node"""
+    def __init__(self, log: typing.Optional[list], name: str):
+        self.log = log
+        self.name = name
+
+
+class _RecordingDict(dict):
+    def __init__(self, content, recorder: _Recording):
+        dict.__init__(self, content)
+        self.recorder = recorder
+
+    def __setitem__(self, key, value):
+        if self.recorder.log is not None:
+            self.recorder.log.append((self.recorder.name, key, value))
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self.recorder.log is not None:
+            self.recorder.log.append((self.recorder.name, key, _DELETED))
+        dict.__delitem__(self, key)
+
+
+class _ReadRecordingDict(_RecordingDict):
+    """additionally records which keys are read, used for definitions of functions in other top level nodes"""
+    def __init__(self, content, recorder: _Recording, reads: typing.Set[str]):
+        _RecordingDict.__init__(self, content, recorder)
+        self.reads = reads
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return dict.__contains__(self, key)
+
+
+class _RecordingSet(set):
+    def __init__(self, content, recorder: _Recording):
+        set.__init__(self, content)
+        self.recorder = recorder
+
+    def add(self, element):
+        if self.recorder.log is not None:
+            self.recorder.log.append((self.recorder.name, element, None))
+        set.add(self, element)
+
+
+_DELETED = object()
+
+
+def _fingerprint(node: Node) -> int:
+    """
+    a hash of a node and all its descendants, which changes when any node in it is replaced, moved or changed.
+    Nodes are identified by their id, thus a replaced node changes the hash even if it generates the same code.
+    """
+    values = []
+    append = values.append
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        childs = list(current)
+        append(id(current))
+        append(len(childs))
+        for name in current.attr_names:
+            value = getattr(current, name)
+            append(tuple(value) if value.__class__ is list else value)
+        childs.reverse()
+        stack += childs
+    return hash(tuple(values))
+
+
+class _Item:
+    """everything known about one node in FileAST.ext"""
+    __slots__ = ("plain", "context", "effects", "visited", "reads")
+
+    def __init__(self):
+        self.plain: Dict[FindNodes, Transforms] = {}
+        self.context: Dict[FindNodes, Transforms] = {}
+        # changes of the context while visiting this node, used to skip it when it was not modified
+        self.effects = None
+        self.visited = False
+        # names of functions which were looked up while visiting this node
+        self.reads: typing.Set[str] = set()
+
+    def modified(self):
+        self.plain.clear()
+        self.context.clear()
+        self.visited = False
+        self.reads = set()
+
+
+class TransformIndex:
+    """
+    Transforms of all transformations for an AST which are kept between transformations.
+    The transforms are stored for every node in FileAST.ext.
+    After a transform is applied, only the transforms of the top level nodes it changed are searched again,
+    all others are reused. Context dependent transforms additionally depend on the declarations before them,
+    which is why all of them are searched again whenever FileAST.ext itself changes.
+    Top level nodes which were changed without the index are found by their fingerprints, see verify.
+    """
+    _indices = weakref.WeakKeyDictionary()
+
+    def __init__(self, ast: c_ast.FileAST, pretty_names=True):
+        self.ast = ast
+        self.pretty_names = pretty_names
+        self._ext = list(ast.ext)
+        self._items: Dict[Node, _Item] = {node: _Item() for node in self._ext}
+        # one ContextView per transformation, cached transforms keep using it for the newest visitor
+        self._views: Dict[FindNodes, ContextView] = {}
+        # transforms of the last search and where the transforms of each top level node start
+        self._found: Dict[FindNodes, Transforms] = {}
+        self._offsets: Dict[FindNodes, List[int]] = {}
+        # properties, scopes and bindings of unchanged nodes are kept between searches
+        self._properties = NodeProperties()
+        self._scopes = Scopes()
+        self._bindings = Bindings()
+        # top level nodes which add_necessities did not change since they were modified,
+        # and FileAST.ext after it was last sorted by decl_first
+        self._normalized: typing.Set[Node] = set()
+        self._sorted: List[Node] = []
+        # generated code of the top level nodes which were not modified since it was generated
+        self._code: Dict[Node, str] = {}
+        # fingerprints of the top level nodes after the index last searched or changed them
+        self._fingerprints: Dict[Node, int] = {node: _fingerprint(node) for node in self._ext}
+
+    @classmethod
+    def of(cls, ast: c_ast.FileAST, pretty_names=True, verify=True) -> "TransformIndex":
+        """
+        returns the index of an AST, the index is kept as long as the AST exists.
+        verify=False skips looking for changes made without the index, see verify.
+        """
+        index = cls._indices.get(ast)
+        if index is None or index.pretty_names != pretty_names or index.ast is not ast:
+            index = cls._indices[ast] = TransformIndex(ast, pretty_names)
+        elif verify:
+            index.verify()
+        return index
+
+    @classmethod
+    def generate(cls, ast: c_ast.FileAST) -> str:
+        """
+        generates the code of an AST like util.generate.
+        If the AST has an index, the code of the top level nodes it did not modify is reused,
+        thus the AST may only be changed by the index since it was created or verified.
+        """
+        index = cls._indices.get(ast)
+        if index is None or index.ast is not ast:
+            return generate(ast)
+        code = index._code
+        fragments = []
+        for node in ast.ext:
+            fragment = code.get(node)
+            if fragment is None:
+                fragment = code[node] = generate_top_level(node)
+            fragments.append(fragment)
+        return "".join(fragments)
+
+    def verify(self):
+        """
+        marks the top level nodes which were changed without the index as modified.
+        Called whenever the index is used by another operation, which may have changed the AST in between.
+        """
+        fingerprints = {}
+        for node in self.ast.ext:
+            fingerprint = _fingerprint(node)
+            if self._fingerprints.get(node, fingerprint) != fingerprint:
+                self._modified(node)
+            fingerprints[node] = fingerprint
+        self._fingerprints = fingerprints
+
+    def all_transforms(self, transforms: typing.Iterable[FindNodes]) -> Dict[FindNodes, Transforms]:
+        """
+        finds all transforms of several transformations,
+        the transforms of each transformation are in the same order as if it was searched for on its own.
+        The transforms have to be executed with apply to keep the index up to date.
+        Deferred transforms are not validated, see validate.
+        """
+        transforms = list(dict.fromkeys(transforms))
+        self._update()
+        with search_tables(self._properties, self._scopes, self._bindings, defer_validation=True):
+            self._search(transforms)
+
+        result = {}
+        for transform in transforms:
+            found = Transforms()
+            offsets = []
+            for node in self._ext:
+                item = self._items[node]
+                offsets.append(len(found))
+                found += (item.context if transform.context else item.plain)[transform]
+            self._offsets[transform] = offsets
+            self._found[transform] = result[transform] = found
+        return result
+
+    def _search(self, transforms: List[FindNodes]):
+        """searches the transforms missing for the top level nodes"""
+        simple = [t for t in transforms if not t.context]
+        for i, node in enumerate(self._ext):
+            item = self._items[node]
+            missing = [t for t in simple if t not in item.plain]
+            if missing:
+                result = {t: Transforms() for t in missing}
+                _collect_transforms(missing, node, ParentChain().push(self.ast), i, None, result)
+                item.plain.update(result)
+
+        contextual = [t for t in transforms if t.context]
+        if contextual:
+            self._visit(contextual)
+
+    def validate(self, transform: FindNodes, index: int) -> bool:
+        """
+        returns whether a transform found by the last search is valid.
+        Deferred transforms are validated in the context they were found in,
+        which is rebuilt by visiting their top level node again.
+        """
+        func = self._found[transform][index]
+        if func.__class__ is not Deferred:
+            return True
+        if not func.validated:
+            with search_tables(self._properties, self._scopes, self._bindings):
+                if transform.context:
+                    self._revisit(transform, bisect.bisect_right(self._offsets[transform], index) - 1, func)
+                func.valid()
+        return func.valid()
+
+    def _revisit(self, transform: FindNodes, position: int, deferred: Deferred):
+        """visits a top level node again to validate a deferred transform while its node is visited"""
+        visitor = ContextVisitor(self.ast, None, transform.func.__name__, self.pretty_names, visit=False)
+        visitor._build_context(self.ast)
+        level = visitor.levels[-1]
+        containers = {f"{time}.{type}": getattr(getattr(level, time), type)
+                      for time in ("past", "future") for type in ("default", "enums", "structs")}
+        containers["func_defs"] = visitor.func_defs
+        containers["globals"] = visitor.globals
+        for node in self._ext[:position]:
+            self._replay(visitor, containers, self._items[node].effects)
+
+        view = self._views[transform]
+        outer = view.visitor, view._types
+        view.visitor, view._types = visitor, {}
+
+        def visit_node(visitor: ContextVisitor, current: Node, parents: typing.List[Node], index):
+            if not deferred.validated and deferred.found_at(current, parents[-1] if parents else None):
+                deferred.valid()
+
+        visitor.visit_node = visit_node
+        try:
+            visitor._visit(self._ext[position], ParentChain().push(self.ast), position)
+        finally:
+            view.visitor, view._types = outer
+
+    def apply(self, transform: FindNodes, index: int):
+        """applies a transform found by the last search and marks the modified top level nodes"""
+        if not self.validate(transform, index):
+            raise ValueError(f"{transform}: {index} is not a valid transform")
+        node = self._ext[bisect.bisect_right(self._offsets[transform], index) - 1]
+        func = self._found[transform][index]
+        func()
+        self._modified(node)
+        # only the changed and new top level nodes are normalized, all others were normalized before
+        for node in self.ast.ext:
+            if node not in self._normalized:
+                if add_necessities(node):
+                    self._modified(node)
+                self._normalized.add(node)
+        if self.ast.ext != self._sorted:
+            decl_first(self.ast)
+            self._sorted = list(self.ast.ext)
+        for node in self.ast.ext:
+            if node not in self._fingerprints:
+                self._fingerprints[node] = _fingerprint(node)
+
+    def _modified(self, node: Node):
+        self._normalized.discard(node)
+        self._code.pop(node, None)
+        self._fingerprints.pop(node, None)
+        item = self._items.get(node)
+        if item is None:
+            return
+        item.modified()
+        self._properties.invalidate(node)
+        self._bindings.invalidate(node)
+        # the scope of the FileAST contains the declarations of this node
+        self._scopes.invalidate(node, [self.ast])
+        if isinstance(node, c_ast.FuncDef):
+            # transforms using this function in other top level nodes are no longer valid
+            name = node.decl.name
+            for other in self._items.values():
+                if name in other.reads:
+                    other.context.clear()
+                    other.visited = False
+        else:
+            # declarations can be used by every context dependent transform and by the types of all expressions
+            self._scopes.forget_types()
+            for other in self._items.values():
+                other.context.clear()
+                other.visited = False
+
+    def _update(self):
+        """starts from scratch if FileAST.ext was changed"""
+        if self._ext != self.ast.ext:
+            self._ext = list(self.ast.ext)
+            self._items = {node: _Item() for node in self._ext}
+            # nodes may have been moved to other top level nodes after they were changed
+            self._properties.clear()
+            self._scopes.clear()
+            self._bindings.clear()
+            self._normalized.intersection_update(self._ext)
+            self._code = {node: self._code[node] for node in self._ext if node in self._code}
+
+    def _visit(self, transforms: List[FindNodes]):
+        """
+        visits all top level nodes which are missing context dependent transforms with one ContextVisitor.
+        All other top level nodes are skipped by replaying how they changed the context.
+        """
+        reads = set()
+        visitor = ContextVisitor(self.ast, None, transforms[0].func.__name__, self.pretty_names, visit=False)
+        visitor._build_context(self.ast)
+        level = visitor.levels[-1]
+        containers = {}
+        for time in "past", "future":
+            for type in "default", "enums", "structs":
+                name = f"{time}.{type}"
+                containers[name] = _RecordingDict(getattr(getattr(level, time), type), _Recording(None, name))
+                setattr(getattr(level, time), type, containers[name])
+        containers["func_defs"] = visitor.func_defs = _ReadRecordingDict(visitor.func_defs, _Recording(None, "func_defs"), reads)
+        containers["globals"] = visitor.globals = _RecordingSet(visitor.globals, _Recording(None, "globals"))
+
+        for transform in transforms:
+            view = self._views.get(transform)
+            if view is None:
+                view = self._views[transform] = ContextView(visitor, transform.func.__name__)
+            view.visitor = visitor
+            view._types = {}
+
+        parents = ParentChain().push(self.ast)
+        outdated = False
+        for i, node in enumerate(self._ext):
+            item = self._items[node]
+            if outdated:
+                item.context.clear()
+                item.visited = False
+            missing = [t for t in transforms if t not in item.context]
+            if not missing and item.visited:
+                self._replay(visitor, containers, item.effects)
+                continue
+
+            result = {t: Transforms() for t in missing}
+
+            def visit_node(visitor: ContextVisitor, current: Node, parents: typing.List[Node], index):
+                for transform in missing:
+                    result[transform] += transform._all_allowed_transforms(current, parents, self._views[transform], index)
+
+            log = []
+            for container in containers.values():
+                container.recorder.log = log
+            reads.clear()
+            visitor.visit_node = visit_node
+            visitor._visit(node, parents, i)
+            for container in containers.values():
+                container.recorder.log = None
+
+            effects = (log, visitor._labels, visitor._labels_of, visitor.current)
+            if item.effects is not None and item.effects[0] != log:
+                # the following top level nodes are visited in a different context
+                outdated = True
+            item.effects = effects
+            item.visited = True
+            item.reads |= reads
+            item.context.update(result)
+
+    @staticmethod
+    def _replay(visitor: ContextVisitor, containers, effects):
+        """changes the context of the visitor in the same way visiting the top level node did"""
+        log, visitor._labels, visitor._labels_of, visitor.current = effects
+        for name, key, value in log:
+            container = containers[name]
+            if name == "globals":
+                set.add(container, key)
+            elif value is _DELETED:
+                dict.__delitem__(container, key)
+            else:
+                dict.__setitem__(container, key, value)
@@ -1,19 +1,69 @@
 import re
 
 
+_COMMENT = re.compile(r"/[/*]")
+_QUOTE = re.compile(r"['\"]")
+# characters which may end a char or a string
+_LITERAL_END = {"'": re.compile(r"[\\']"), '"': re.compile(r'[\\"]')}
+
+
+def _literal_end(text, start, quote):
+    """returns the end of the char or string starting at start or -1 if it is not closed"""
+    end = _LITERAL_END[quote]
+    position = start + 1
+    while match := end.search(text, position):
+        if text[match.start()] == quote:
+            return match.end()
+        # an escaped character, which may be a quote or a newline
+        position = match.start() + 2
+        if position > len(text):
+            break
+    return -1
+
+
 def remove_comments(text):
     r"""
     Replace comments with a space.
-    \\\\ and \\* *\\ in strings are ignored by replacing strings with themselves
+    \\\\ and \\* *\\ in strings are ignored by skipping strings.
+    The text is scanned once, unclosed comments, chars and strings are treated as code.
+    Only chars and strings before a comment are searched, thus code without comments is returned at once.
     :param text: text to replace comments in
     :return: text without comments
     """
-    single_line_comment = r"//.*?$"
-    multi_line_comment = r"/\*.*?\*/"
-    char = r"'(\\.|[^\\'])*'"
-    string = r'"(\\.|[^\\"])*"'
-    return re.sub('(?s)(?m)' + '|'.join((single_line_comment, multi_line_comment, char, string)),
-                  lambda m: ' ' if m.group(0).startswith('/') else m.group(0), text)
+    parts = []
+    copied = 0  # the text before this index is in parts
+    position = 0
+    # once a char or string is not closed, no later one of the same kind is closed either
+    unclosed = set()
+    comment = _COMMENT.search(text)
+    while comment:
+        start = comment.start()
+        # a char or string before the comment may contain it
+        quote = _QUOTE.search(text, position, start)
+        if quote:
+            first = quote.group()
+            end = -1 if first in unclosed else _literal_end(text, quote.start(), first)
+            if end < 0:
+                unclosed.add(first)
+                position = quote.start() + 1
+            else:
+                position = end
+        else:
+            if text[start + 1] == "/":
+                end = text.find("\n", start + 2)
+                end = len(text) if end < 0 else end
+            else:
+                end = text.find("*/", start + 2)
+                end = -1 if end < 0 else end + 2
+            if end < 0:
+                position = start + 1
+            else:
+                parts += (text[copied:start], " ")
+                copied = position = end
+        if start < position:
+            comment = _COMMENT.search(text, position)
+    parts.append(text[copied:])
+    return "".join(parts)
 
 
 def regex(code: str) -> str:
@@ -1,15 +1,19 @@
+import bisect
+import contextlib
+import itertools
 import re
 import logging
 import math
+import time
 import typing
-from functools import cache
 from typing import List, Union, Callable, Optional
 
 from pycparser import c_ast
 from pycparser.c_ast import Node, FuncDef
 
-from semtransforms.context import ContextVisitor, decl_type
-from semtransforms.util import NoNode, fnn
+from semtransforms.context import ContextVisitor, ContextView, Scopes, decl_type
+from semtransforms.util import NoNode, ParentChain, fnn, preorder, properties
+from semtransforms.util.properties import NodeProperties
 
 
 FUNCTION_BLACKLIST = [
@@ -21,12 +25,9 @@ FUNCTION_BLACKLIST = [
 
 def edit_allowed(function_name):
     for name_or_pattern in FUNCTION_BLACKLIST:
-        if function_name == name_or_pattern        : return False
-
-        try:
-            if name_or_pattern.match(function_name): return False
-        except AttributeError:
-            continue
+        if name_or_pattern.__class__ is str:
+            if function_name == name_or_pattern: return False
+        elif name_or_pattern.match(function_name): return False
 
     return True
 
@@ -102,6 +103,106 @@ class SingleNode(Content):
         yield getattr(self.parent, self.attr_name)
 
 
+class LazyTransforms(typing.Sequence):
+    """a sequence of transforms which creates a transform only when it is accessed"""
+    __slots__ = ("length", "create")
+
+    def __init__(self, length: int, create: Callable[[int], Callable]):
+        self.length = length
+        self.create = create
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index: int) -> Callable:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("transform index out of range")
+        return self.create(index)
+
+
+class Transforms(typing.Sequence):
+    """concatenation of lists of transforms, lazy parts are not expanded"""
+    __slots__ = ("parts", "offsets", "length")
+
+    def __init__(self, *parts: typing.Sequence[Callable]):
+        self.parts = []
+        self.offsets = []
+        self.length = 0
+        for part in parts:
+            self += part
+
+    def __iadd__(self, part: typing.Sequence[Callable]):
+        if part.__class__ is Transforms:
+            for p in part.parts:
+                self += p
+        elif part:
+            self.parts.append(part)
+            self.offsets.append(self.length)
+            self.length += len(part)
+        return self
+
+    def __add__(self, other: typing.Sequence[Callable]):
+        return Transforms(self, other)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index: int) -> Callable:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("transform index out of range")
+        part = bisect.bisect_right(self.offsets, index) - 1
+        return self.parts[part][index - self.offsets[part]]
+
+
+class Deferred:
+    """
+    A transform with an expensive validation, which only has to be run once the transform is chosen.
+    validate returns the transform or None if it is not valid,
+    it has to be run in the context of the node which was visited when the transform was found.
+    """
+    __slots__ = ("validate", "node", "parent", "transformation", "transform", "validated")
+
+    def __init__(self, validate: Callable[[], Optional[Callable]]):
+        self.validate = validate
+        # the node which was visited and the transformation, they are set when the transform is found
+        self.node: Optional[Node] = None
+        self.parent: Optional[Node] = None
+        self.transformation: Optional["FindNodes"] = None
+        self.transform: Optional[Callable] = None
+        self.validated = False
+
+    def found_at(self, node: Node, parent: Optional[Node]) -> bool:
+        """whether the transform was found while visiting node, NoNodes are identified by their parent"""
+        if node.__class__ is NoNode:
+            return self.node.__class__ is NoNode and parent is self.parent
+        return node is self.node
+
+    def valid(self) -> bool:
+        """runs the validation once, the context has to be the one of the visited node"""
+        if not self.validated:
+            start = time.perf_counter()
+            try:
+                self.transform = self.validate()
+            except MemoryError:
+                # the memory of the process is exhausted, not only the one of this transformation
+                raise
+            except Exception as e:
+                self.transform = None
+                if self.transformation is not None:
+                    self.transformation.failed(e, start)
+            self.validated = True
+        return self.transform is not None
+
+    def __call__(self):
+        if not self.valid():
+            raise ValueError("the transform is not valid")
+        self.transform()
+
+
 def must_be_first(ast: Node):
     match ast:
         case c_ast.Typedef():
@@ -115,30 +216,57 @@ def decl_first(ast: c_ast.FileAST):
     ast.ext = [node for node in ast if must_be_first(node)] + [node for node in ast if not must_be_first(node)]
 
 
-def add_necessities(ast: Node):
+def add_necessities(ast: Node) -> bool:
+    """adds compounds to ifs and statements to empty cases, returns whether anything was added"""
     def to_compound(child):
         return c_ast.Compound([child] if child else [])
-    if isinstance(ast, c_ast.If):
-        if not isinstance(ast.iftrue, c_ast.Compound):
-            ast.iftrue = to_compound(ast.iftrue)
-        if not isinstance(ast.iffalse, c_ast.Compound):
-            ast.iffalse = to_compound(ast.iffalse)
-    match ast:
-        case c_ast.Case(stmts=[]) as case:
-            case.stmts.append(c_ast.EmptyStatement())
-    for c in ast:
-        if c:
-            add_necessities(c)
+    added = False
+    # the childs of a node are visited after they are added
+    for node in preorder(ast):
+        if node.__class__ is c_ast.If:
+            if not isinstance(node.iftrue, c_ast.Compound):
+                node.iftrue = to_compound(node.iftrue)
+                added = True
+            if not isinstance(node.iffalse, c_ast.Compound):
+                node.iffalse = to_compound(node.iffalse)
+                added = True
+        match node:
+            case c_ast.Case(stmts=[]) as case:
+                case.stmts.append(c_ast.EmptyStatement())
+                added = True
+    return added
+
+
+class Failures:
+    """exceptions swallowed while searching the transforms of a transformation"""
+    __slots__ = ("count", "seconds", "types")
+
+    def __init__(self):
+        self.count = 0
+        # time spent in the calls which failed
+        self.seconds = 0.
+        self.types: typing.Dict[str, int] = {}
+
+    def statistics(self) -> dict:
+        return {"count": self.count, "seconds": self.seconds, "types": dict(self.types)}
 
 
 class FindNodes:
     """Baseclass for transformations"""
     all = {}
+    # exceptions swallowed by each transformation, see failure_statistics
+    failures: typing.Dict[str, Failures] = {}
+    # properties of nodes used by all transformations, replaced by each search
+    properties = NodeProperties()
+    # bindings of identifiers, only set while searching
+    bindings: Optional["Bindings"] = None
+    # whether deferred validations are kept for the chosen transforms instead of being run while searching
+    defer_validation = False
 
     def __init__(self, func, context: bool):
         """signature of func:
         (self, parents: List[Node], stmts: Content, context: ContextVisitor, index: int)
-            -> Union[List[Callable], Callable, None]"""
+            -> Union[List[Callable], LazyTransforms, Callable, None]"""
         self.func = func
         self.context = context
         FindNodes.all[func.__name__] = self
@@ -146,123 +274,184 @@ class FindNodes:
     def __repr__(self):
         return self.func.__name__
 
-    def _transforms(self, parents: List[Node], stmts: Content, context: ContextVisitor) -> List[Callable]:
+    def failed(self, exception: Exception, start: float):
+        """counts an exception which was swallowed in a call started at start"""
+        failures = FindNodes.failures.get(self.func.__name__)
+        if failures is None:
+            failures = FindNodes.failures[self.func.__name__] = Failures()
+        failures.count += 1
+        failures.seconds += time.perf_counter() - start
+        name = exception.__class__.__name__
+        failures.types[name] = failures.types.get(name, 0) + 1
+
+    @staticmethod
+    def failure_statistics() -> typing.Dict[str, dict]:
+        """the exceptions swallowed by each transformation since the last reset_failures"""
+        return {name: failures.statistics() for name, failures in FindNodes.failures.items()}
+
+    @staticmethod
+    def reset_failures():
+        FindNodes.failures.clear()
+
+    def _transforms(self, parents: List[Node], stmts: Content, context: ContextVisitor) -> typing.Sequence[Callable]:
         """creates an appropriate list for each return of transforms"""
+        start = time.perf_counter()
         try:
             result = self.func(self, parents, stmts, context)
+            if result.__class__ is Deferred:
+                if not FindNodes.defer_validation:
+                    result = result.validate()
+                elif context is not None:
+                    result.node = context.current
+                    result.parent = parents[-1] if parents else None
+                    result.transformation = self
             if not result:
                 return []
-            if isinstance(result, List):
+            if isinstance(result, (List, LazyTransforms)):
                 return result
             if callable(result):
                 return [result]
             logging.warning("Unhandled type: " + result.__class__)
             return []
-        except Exception:
+        except MemoryError:
+            raise
+        except Exception as e:
+            self.failed(e, start)
             return []
 
     def _all_transforms(self, ast: Node, parents: List[Node], context: Optional[ContextVisitor], child_index: int) -> \
-    List[Callable]:
+    typing.Sequence[Callable]:
         """finds for one child all valid transforms"""
         raise NotImplementedError("Not implemented in baseclass")
 
     def _allow_transform(self, ast: Node, parents: List[Node], context: Optional[ContextVisitor], child_index):
         # We only allow transforms that are not inside black listed functions
         
-        for parent_function_definition in filter(lambda x: isinstance(x, FuncDef), parents):
+        if isinstance(parents, ParentChain):
+            func_defs = parents.func_defs
+        else:
+            func_defs = filter(lambda x: isinstance(x, FuncDef), parents)
+        for parent_function_definition in func_defs:
             name = parent_function_definition.decl.name
             if not edit_allowed(name): return False
 
         return True
 
     def _all_allowed_transforms(self, ast: Node, parents: List[Node], context: Optional[ContextVisitor], child_index: int) -> \
-    List[Callable]:
+    typing.Sequence[Callable]:
         """finds for one child all allowed transforms"""
 
         if not self._allow_transform(ast, parents, context, child_index): return []
         return self._all_transforms(ast, parents, context, child_index)
 
 
-    def all_transforms(self, ast: Node, parents: List[Node] = [], index: int = 0, pretty_names=True) -> List[Callable]:
+    def all_transforms(self, ast: Node, parents: List[Node] = [], index: int = 0, pretty_names=True) -> Transforms:
         """iterates through all childs and finds where the AST can be transformed"""
-        is_root = not parents
-        if is_root:
-            self.has_side_effects.cache_clear()
-            self.has_node.cache_clear()
-
-        if self.context:
-            result = []
-
-            def visit_node(visitor: ContextVisitor, current: Node, parents: typing.List[Node], index):
-                result.extend(self._all_allowed_transforms(current, parents, visitor, index))
-
-            ContextVisitor(ast, visit_node, self.func.__name__, pretty_names)
-        else:
-            result = self._all_allowed_transforms(ast, parents, None, index)
-            parents = [] + parents + [ast]
-            i = 0
-            for c in ast:
-                if c:
-                    result += self.all_transforms(c, parents, i, pretty_names)
-                    i += 1
-            if ast.__class__ in (c_ast.Compound, c_ast.Case, c_ast.Default):
-                result += self.all_transforms(NoNode(), parents, i, pretty_names)
-
-        def wrapper(func):
-            func()
-            add_necessities(ast)
-            decl_first(ast)
-
-        if is_root:
-            result = [lambda: wrapper(func) for func in result]
-        return result
+        if not parents:
+            return all_transforms(ast, [self], pretty_names)[self]
+        result = {self: Transforms()}
+        _collect_transforms([self], ast, ParentChain.of(parents), index, None, result)
+        return result[self]
 
-    @cache
     def has_side_effects(self, node: Node) -> bool:
-        match node:
-            case c_ast.Assignment():
-                return True
-
-            # Function might have a side effect
-            case c_ast.FuncCall():
-                return True
-
-            case c_ast.UnaryOp(op=op, expr=expr):
-                return op in "p++p--" or self.has_side_effects(expr)
-        for child in node:
-            if self.has_side_effects(child):
-                return True
-        return False
+        return self.properties.has(node, properties.SIDE_EFFECTS)
 
     def has_break(self, node: Node) -> bool:
-        return self.has_node(node, (c_ast.Break,), (c_ast.Switch, c_ast.While, c_ast.For))
+        return self.properties.has(node, properties.BREAK)
 
     def has_return(self, node: Node) -> bool:
-        return self.has_node(node, (c_ast.Return,))
+        return self.properties.has(node, properties.RETURN)
 
     def has_jumps(self, node: Node) -> bool:
-        return self.has_node(node, (c_ast.Label, c_ast.Goto))
+        return self.properties.has(node, properties.JUMP)
 
     def has_struct_ref(self, node: Node) -> bool:
-        return self.has_node(node, (c_ast.StructRef,))
+        return self.properties.has(node, properties.STRUCT_REF)
 
     def has_func_calls(self, node : Node) -> bool:
-        return self.has_node(node, (c_ast.FuncCall,))
+        return self.properties.has(node, properties.FUNC_CALL)
+
+
+def _collect_transforms(transforms: List[FindNodes], ast: Node, parents: ParentChain, index: int,
+                        context: Optional[ContextVisitor], result: typing.Dict[FindNodes, Transforms]):
+    """adds the transforms of a node and all its childs to result"""
+    stack = [(ast, parents, index)]
+    while stack:
+        ast, parents, index = stack.pop()
+        for transform in transforms:
+            result[transform] += transform._all_allowed_transforms(ast, parents, context, index)
+        if ast.__class__ is NoNode:
+            continue
+        if ast.__class__ is FuncDef and not edit_allowed(ast.decl.name):
+            # nothing inside of a function which may not be edited is transformed
+            continue
+        childs = [c for c in ast if c]
+        if ast.__class__ in (c_ast.Compound, c_ast.Case, c_ast.Default):
+            childs.append(NoNode())
+        if childs:
+            parents = parents.push(ast)
+            stack += [(childs[i], parents, i) for i in range(len(childs) - 1, -1, -1)]
 
-    @cache
-    def has_node(self, node: Node, true=(), false=()):
-        """
-        Searches recursively through the node.
-        Returns True iff there is a Node with a class in true before there is one with a class in false
-        """
-        if node.__class__ in true:
-            return True
-        if node.__class__ in false:
-            return False
-        for child in node:
-            if self.has_node(child, true, false):
-                return True
-        return False
+
+@contextlib.contextmanager
+def search_tables(properties: NodeProperties, scopes: Scopes, bindings: "Bindings", defer_validation=False):
+    """
+    uses the node properties, scopes and bindings while searching, they must be valid for the searched AST.
+    With defer_validation, Deferred transforms are not validated while searching.
+    """
+    outer = FindNodes.properties, ContextVisitor.scopes, FindNodes.bindings, FindNodes.defer_validation
+    FindNodes.properties, ContextVisitor.scopes, FindNodes.bindings = properties, scopes, bindings
+    FindNodes.defer_validation = defer_validation
+    try:
+        yield
+    finally:
+        FindNodes.properties, ContextVisitor.scopes, FindNodes.bindings, FindNodes.defer_validation = outer
+
+
+def _search(ast: Node, transforms: List[FindNodes], result: typing.Dict[FindNodes, Transforms], pretty_names):
+    """adds the transforms of all transformations to result"""
+    simple = [t for t in transforms if not t.context]
+    if simple:
+        _collect_transforms(simple, ast, ParentChain(), 0, None, result)
+
+    contextual = [t for t in transforms if t.context]
+    if contextual:
+        views = {}
+
+        def visit_node(visitor: ContextVisitor, current: Node, parents: typing.List[Node], index):
+            if not views:
+                views.update((t, ContextView(visitor, t.func.__name__)) for t in contextual)
+            for transform in contextual:
+                result[transform] += transform._all_allowed_transforms(current, parents, views[transform], index)
+
+        ContextVisitor(ast, visit_node, contextual[0].func.__name__, pretty_names)
+
+
+def all_transforms(ast: Node, transforms: typing.Iterable[FindNodes], pretty_names=True) \
+        -> typing.Dict[FindNodes, Transforms]:
+    """
+    finds all transforms of several transformations at once.
+    Transformations without context share one traversal, transformations with context share one ContextVisitor.
+    The transforms of each transformation are in the same order as if it was searched for on its own.
+    """
+    transforms = list(dict.fromkeys(transforms))
+    result = {transform: Transforms() for transform in transforms}
+    if ContextVisitor.scopes is None:
+        # the AST may have been changed since the last search
+        with search_tables(NodeProperties(), Scopes(), Bindings()):
+            _search(ast, transforms, result, pretty_names)
+    else:
+        # a search inside of a transformation does not change the AST, thus it uses the tables of the outer search
+        with search_tables(FindNodes.properties, ContextVisitor.scopes, FindNodes.bindings):
+            _search(ast, transforms, result, pretty_names)
+
+    def wrapper(func):
+        func()
+        add_necessities(ast)
+        decl_first(ast)
+
+    return {transform: Transforms(LazyTransforms(len(funcs), lambda i, funcs=funcs: lambda: wrapper(funcs[i])))
+            for transform, funcs in result.items()}
 
 
 def find_statements(context: bool = False, modifiable_length: bool = True,
@@ -296,19 +485,24 @@ class FindStatements(FindNodes):
         """returns transforms on childs if modifiable_length is fullfilled (or not necessary)"""
         if self.modifiable_length and (self.min_length or 0) <= 1 <= (self.max_length or 1):
             return []
-        return [t for transforms in [self._transforms(parents, SingleNode(ast, name), context) for name in names] for t
-                in transforms]
+        return Transforms(*(self._transforms(parents, SingleNode(ast, name), context) for name in names))
 
-    def _all_transforms(self, ast: Node, parents: List[Node], context: ContextVisitor, child_index: int) -> List:
+    def _all_transforms(self, ast: Node, parents: List[Node], context: ContextVisitor, child_index: int) -> Transforms:
         """finds statements in a node"""
-        match parents:
-            case [*_, c_ast.Case()]: child_index -= 1
-        result = []
-        match parents:
-            case [*_, c_ast.Case(stmts=all)] | [*_, c_ast.Default(stmts=all)] | [*_, c_ast.Compound(block_items=all)]:
+        # only the last parent is matched, matching the whole parents would access them several times
+        parent = parents[-1] if parents else None
+        match parent:
+            case c_ast.Case(): child_index -= 1
+        result = Transforms()
+        match parent:
+            case c_ast.Case(stmts=all) | c_ast.Default(stmts=all) | c_ast.Compound(block_items=all):
                 if self.min_length >= 0:
                     for end in range(child_index + self.min_length, min(child_index + self.max_length, len(all)) + 1):
-                        result += self._transforms(parents, Nodes(all, child_index, end), context)
+                        stmts = Nodes(all, child_index, end)
+                        # the expression of a case has the index -1, the statements found for it are mostly empty
+                        if child_index < 0 and self.min_length and not stmts.content():
+                            continue
+                        result += self._transforms(parents, stmts, context)
                 elif child_index == 0:
                     result += self._transforms(parents, Nodes(all, 0, len(all)), context)
     
@@ -339,55 +533,151 @@ class FindExpression(FindNodes):
     def __init__(self, func, context: bool = False):
         FindNodes.__init__(self, func, context)
 
-    def _all_transforms(self, ast: Node, parents: List[Node], context: ContextVisitor, child_index: int) -> List:
+    def _all_transforms(self, ast: Node, parents: List[Node], context: ContextVisitor, child_index: int) -> Transforms:
         """finds expressions in a node"""
-        result = []
-        if parents:
-            for slot in parents[-1].__slots__:
-                attr = getattr(parents[-1], slot)
-                if isinstance(attr, Node):
-                    child_index -= 1
-                    if child_index < 0:
-                        break
-                if isinstance(attr, list) and len(attr) > child_index and attr[child_index] is ast:
-                    result += self._transforms(parents, Nodes(attr, child_index, child_index + 1), context)
+        result = Transforms()
+        for expr_parents, expr in _expressions(ast, parents, child_index):
+            result += self._transforms(expr_parents, expr, context)
+        return result
+
+
+def _expressions(ast: Node, parents: List[Node], child_index: int) -> List[typing.Tuple[ParentChain, Content]]:
+    """the expressions of a node: the node itself if it is in a list and all childs which are not in a list"""
+    result = []
+    if parents:
+        for slot in parents[-1].__slots__:
+            attr = getattr(parents[-1], slot)
+            if isinstance(attr, Node):
+                child_index -= 1
+                if child_index < 0:
                     break
+            if isinstance(attr, list) and len(attr) > child_index and attr[child_index] is ast:
+                result.append((parents, Nodes(attr, child_index, child_index + 1)))
+                break
+
+    childs_parents = None
+    for slot in ast.__slots__:
+        child = getattr(ast, slot)
+        if issubclass(child.__class__, Node):
+            if childs_parents is None:
+                childs_parents = ParentChain.of(parents).push(ast)
+            result.append((childs_parents, SingleNode(ast, slot)))
+    return result
+
+
+class Bindings:
+    """
+    The identifiers of an AST and the values of the declarations they are bound to.
+    All identifiers in a node are bound by one ContextVisitor, the bindings are reused for all its descendants.
+    The bindings are kept until they are invalidated, thus modified nodes have to be invalidated.
+    """
+    def __init__(self):
+        # when a node was visited, the identifiers of different nodes are ordered by it
+        self._order: typing.Dict[Node, int] = {}
+        self._counter = itertools.count()
+        # identifiers found while visiting a node with their parents and the value they are bound to
+        self._ids: typing.Dict[Node, List[typing.Tuple[Content, ParentChain, Optional[Node]]]] = {}
+
+    def _bind(self, root: Node):
+        """visits root to bind all identifiers in it"""
+        order, ids, counter = self._order, self._ids, self._counter
+
+        def visit_node(visitor: ContextVisitor, current: Node, parents: ParentChain, index):
+            if current.__class__ is NoNode:
+                return
+            order[current] = next(counter)
+            found = [(expr, expr_parents, visitor.value(expr[0].name))
+                     for expr_parents, expr in _expressions(current, parents, index)
+                     if expr[0].__class__ is c_ast.ID]
+            if found:
+                ids[current] = found
+            else:
+                ids.pop(current, None)
+
+        ContextVisitor(root, visit_node, "bindings", True)
+
+    def identifiers(self, root: Node) -> List[typing.Tuple[Content, ParentChain, Optional[Node]]]:
+        """
+        returns the identifiers in root in the order of a ContextVisitor and their values inside of root,
+        identifiers which are not declared in root have no value except for predefined ones.
+        The parents start at root, as if the ContextVisitor started at root.
+        """
+        if root not in self._order:
+            self._bind(root)
+        inside = set()
+        found = []
+        for node in preorder(root):
+            inside.add(node)
+            ids = self._ids.get(node)
+            if ids:
+                found.append((self._order[node], node, ids))
+        found.sort(key=lambda f: f[0])
+
+        # the identifiers may have been bound by a visitor starting at a parent of root,
+        # their parents are shared like the parents of a visitor starting at root
+        chains = {}
+
+        def starting_at_root(parents: ParentChain) -> ParentChain:
+            if parents.root is root:
+                return parents
+            missing = []
+            while id(parents) not in chains and parents.node is not root:
+                missing.append(parents)
+                parents = parents.parent
+            chain = chains.get(id(parents))
+            if chain is None:
+                chain = chains[id(parents)] = ParentChain().push(root)
+            for parents in reversed(missing):
+                chains[id(parents)] = chain = chain.push(parents.node)
+            return chain
 
-        for slot in ast.__slots__:
-            child = getattr(ast, slot)
-            if issubclass(child.__class__, Node):
-                result += self._transforms(parents + [ast], SingleNode(ast, slot), context)
+        result = []
+        for _, node, ids in found:
+            for expr, parents, value in ids:
+                if node is root and expr.__class__ is Nodes:
+                    continue  # root itself has no parents
+                parents = starting_at_root(parents)
+                if not all(edit_allowed(func_def.decl.name) for func_def in parents.func_defs):
+                    continue
+                if value is not None and value not in inside and expr[0].name != "__PRETTY_FUNCTION__":
+                    value = None
+                result.append((expr, parents, value))
         return result
 
+    def invalidate(self, node: Node):
+        """forgets the bindings of a node and its descendants"""
+        for n in preorder(node):
+            self._order.pop(n, None)
+            self._ids.pop(n, None)
+
+    def clear(self):
+        self._order.clear()
+        self._ids.clear()
+
+
+def _bindings() -> Bindings:
+    """the bindings of the current search, without a search the AST may have been changed"""
+    return FindNodes.bindings if ContextVisitor.scopes is not None else Bindings()
+
+
+def _is_field(expr: Content, parents: ParentChain) -> bool:
+    match parents[-1]:
+        case c_ast.StructRef(field=field) if field is expr[0]:
+            return True
+    return False
+
 
 def references(parent: Node, decl: c_ast.Decl) -> typing.List[typing.Tuple[SingleNode, List[Node]]]:
     """finds all references to decl in parent,
     assuming the name of the declaration is valid at the beginning of the node"""
-    result = []
-
-    @find_expressions(context=True)
-    def inner(visitor: FindExpression, parents: typing.List[Node], stmts: SingleNode, context: ContextVisitor):
-        match parents[-1]:
-            case c_ast.StructRef(field=field) if field is stmts[0]:
-                return
-        match stmts[0]:
-            case c_ast.ID(name=decl.name) if context.value(decl.name, decl_type(decl)) is decl:
-                result.append((stmts, parents))
-    inner.all_transforms(parent)
-    return result
+    if decl_type(decl) != "default":
+        # declarations of structs and enums can not be referenced by an identifier
+        return []
+    return [(expr, parents) for expr, parents, value in _bindings().identifiers(parent)
+            if value is decl and expr[0].name == decl.name and not _is_field(expr, parents)]
 
 
 def unknown_references(parent: Node) -> typing.List[typing.Tuple[SingleNode, List[Node]]]:
     """finds all references in parent for which there is no declaration in parent"""
-    result = []
-
-    @find_expressions(context=True)
-    def inner(visitor: FindExpression, parents: typing.List[Node], stmts: SingleNode, context: ContextVisitor):
-        if stmts[0].__class__ is c_ast.ID and not context.value(stmts[0].name):
-            match stmts:
-                case SingleNode(parent=c_ast.StructRef(field=f)) if f is stmts[0]:
-                    return
-            result.append((stmts, parents))
-        pass
-    inner.all_transforms(parent)
-    return result
\ No newline at end of file
+    return [(expr, parents) for expr, parents, value in _bindings().identifiers(parent)
+            if not value and not _is_field(expr, parents)]
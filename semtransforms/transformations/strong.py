@@ -1,6 +1,3 @@
-import copy
-from copy import deepcopy
-
 from pycparser.c_ast import *
 
 from semtransforms.transformation import *
@@ -45,7 +42,7 @@ def re_ref_locals(self, parents: List[Node], expr: Content, context: ContextVisi
 @verifier.nondet("int")
 def add_if_rand(self, parents: List[Node], stmts: Content, context: ContextVisitor):
     if not isinstance(stmts[0], Decl) and duplicateable(stmts[0]):
-        return lambda: stmts.replace(If(verifier.nondet_call("int"), stmts[0], deepcopy(stmts[0])))
+        return lambda: stmts.replace(If(verifier.nondet_call("int"), stmts[0], clone(stmts[0])))
 
 
 @find_statements(length=1, modifiable_length=False, context=True)
@@ -54,7 +51,7 @@ def deepen_while(finder: FindStatements, parents: List[Node], stmts: Content, co
     match stmts[0]:
         case While(cond=cond, stmt=stmt) as w if not (finder.has_side_effects(cond) or finder.has_break(stmt)):
             if not finder.has_func_calls(cond):
-                return lambda: setattr(w, "stmt", While(BinaryOp("&", verifier.nondet_call("int"), deepcopy(cond)), stmt))
+                return lambda: setattr(w, "stmt", While(BinaryOp("&", verifier.nondet_call("int"), clone(cond)), stmt))
             
             def transform():
                 _restructure_loop_with_func_call_condition(context, stmts)
@@ -62,11 +59,11 @@ def deepen_while(finder: FindStatements, parents: List[Node], stmts: Content, co
                 if isinstance(w.stmt, c_ast.Compound):
                     *w.stmt.block_items, restructure_assign = w.stmt.block_items
                     w.stmt = Compound(block_items = [
-                        While(BinaryOp("&", verifier.nondet_call("int"), deepcopy(cond)), stmt),
+                        While(BinaryOp("&", verifier.nondet_call("int"), clone(cond)), stmt),
                         restructure_assign
                     ])
                 else:
-                    w.stmt = While(BinaryOp("&", verifier.nondet_call("int"), deepcopy(cond)), stmt)
+                    w.stmt = While(BinaryOp("&", verifier.nondet_call("int"), clone(cond)), stmt)
 
             return transform
 
@@ -105,40 +102,48 @@ def to_method(finder: FindStatements, parents: List[Node], stmts: Content, conte
         if len(stmts[0].block_items) == 0: return
 
         name = context.free_name(prefix = "func_")
-        # get names and types of all variables defined before used in this block
-        urs = unknown_references(stmts[0])
-        local_urs = [ur for ur in urs if ur[0][0].name not in context.globals]
-        local_names = {ur[0][0].name for ur in local_urs}
-        original_params = [context.value(id) for id in local_names]
-
-        # Why is this needed? We can process variable array sizes via pointers
-        if any(has_variable_array_size(p) for p in original_params):
-            return
-
-        def transform():
-            # create pointer params from variables and clear declaration specifiers
-            params = [copy.deepcopy(p) for p in original_params]
-            for param in params:
-                param.init = None
+        # the free variables are only analyzed once this transform is chosen
+        def validate():
+            # get names and types of all variables defined before used in this block
+            urs = unknown_references(stmts[0])
+            local_urs = [ur for ur in urs if ur[0][0].name not in context.globals]
+            local_names = {ur[0][0].name for ur in local_urs}
+            original_params = [context.value(id) for id in local_names]
+
+            # only variables can be passed as pointers, functions which are defined later have no declaration yet
+            if any(not isinstance(p, Decl) or isinstance(p.type, FuncDecl) for p in original_params):
+                return
+
+            # Why is this needed? We can process variable array sizes via pointers
+            if any(has_variable_array_size(p) for p in original_params):
+                return
+
+            def transform():
+                # create pointer params from variables and clear declaration specifiers
+                params = [clone(p) for p in original_params]
+                for param in params:
+                    param.init = None
                 
-                #if isinstance(param.type, ArrayDecl):
-                #    param.type = PtrDecl([], param.type.type)
-
-                param.type = PtrDecl([], param.type)
-                param.storage = []
-                param.funcspec = []
-
-            for node, _ in local_urs:
-                node.replace(UnaryOp("*", node[0]))
-            # create function at the start of the program
-            void_function = _declare_void_function(name, params)
-            void_function = _define_function(name, void_function, stmts[0])
-            parent_pos    = _find_parent_pos_in_ext(parents)
-            parents[0].ext.insert(parent_pos, void_function)
-            # call the function
-            stmts.replace(FuncCall(ID(name), ExprList([UnaryOp("&", ID(id)) for id in local_names])))
+                    #if isinstance(param.type, ArrayDecl):
+                    #    param.type = PtrDecl([], param.type.type)
+
+                    param.type = PtrDecl([], param.type)
+                    param.storage = []
+                    param.funcspec = []
+
+                for node, _ in local_urs:
+                    node.replace(UnaryOp("*", node[0]))
+                # create function at the start of the program
+                void_function = _declare_void_function(name, params)
+                void_function = _define_function(name, void_function, stmts[0])
+                parent_pos    = _find_parent_pos_in_ext(parents)
+                parents[0].ext.insert(parent_pos, void_function)
+                # call the function
+                stmts.replace(FuncCall(ID(name), ExprList([UnaryOp("&", ID(id)) for id in local_names])))
 
-        return transform
+            return transform
+
+        return Deferred(validate)
 
 
 @find_statements(length=1, modifiable_length=False, context=True)
@@ -151,61 +156,69 @@ def to_recursive(finder: FindStatements, parents: List[Node], stmts: Content, co
 
         name = context.free_name(prefix = "func_")
 
-        # get names and types of all variables defined before used in this block
-        urs = unknown_references(stmts[0])
-        local_urs = [ur for ur in urs if ur[0][0].name not in context.globals]
-        local_names = {ur[0][0].name for ur in local_urs}
-        original_params = [context.value(id) for id in local_names]
-
-        # Why is this needed? We can process variable array sizes via pointers
-        if any(has_variable_array_size(p) for p in original_params):
-            return
-
-        def transform():
-            # create pointer params from variables and clear declaration specifiers
-            params = [copy.deepcopy(p) for p in original_params]
-            for param in params:
-                param.init = None
-
-                #if isinstance(param.type, ArrayDecl):
-                #    param.type = PtrDecl([], param.type.type)
-
-                param.type = PtrDecl([], param.type)
-                param.storage = []
-                param.funcspec = []
-
-            for node, _ in local_urs:
-                node.replace(UnaryOp("*", node[0]))
-
-            def break2return(node: Node):
-                for slot in node.__slots__:
-                    child = getattr(node, slot)
-                    if isinstance(child, list):
-                        for i in range(len(child)):
-                            if child[i].__class__ in (For, While, Switch):
-                                break
-                            elif isinstance(child[i], Break):
-                                child[i:i+1] = [Return(None)]
-                            elif isinstance(child[i], Node):
-                                break2return(child[i])
-                    elif child.__class__ in (For, While, Switch):
-                        break
-                    elif isinstance(child, Break):
-                        setattr(node, slot, Return(None))
-                    elif isinstance(child, Node):
-                        break2return(child)
-            break2return(stmts[0])
-
-            # create function at the start of the program
-            call = FuncCall(ID(name), ExprList([ID(id) for id in local_names]))
-            void_function = _declare_void_function(name, params)
-            void_function = _define_function(name, void_function, Compound([If(stmts[0].cond, Compound([stmts[0].stmt, call]), None)]))
-            parent_pos    = _find_parent_pos_in_ext(parents)
-            parents[0].ext.insert(parent_pos, void_function)
-            # call the function
-            stmts.replace(FuncCall(ID(name), ExprList([UnaryOp("&", ID(id)) for id in local_names])))
+        # the free variables are only analyzed once this transform is chosen
+        def validate():
+            # get names and types of all variables defined before used in this block
+            urs = unknown_references(stmts[0])
+            local_urs = [ur for ur in urs if ur[0][0].name not in context.globals]
+            local_names = {ur[0][0].name for ur in local_urs}
+            original_params = [context.value(id) for id in local_names]
 
-        return transform
+            # only variables can be passed as pointers, functions which are defined later have no declaration yet
+            if any(not isinstance(p, Decl) or isinstance(p.type, FuncDecl) for p in original_params):
+                return
+
+            # Why is this needed? We can process variable array sizes via pointers
+            if any(has_variable_array_size(p) for p in original_params):
+                return
+
+            def transform():
+                # create pointer params from variables and clear declaration specifiers
+                params = [clone(p) for p in original_params]
+                for param in params:
+                    param.init = None
+
+                    #if isinstance(param.type, ArrayDecl):
+                    #    param.type = PtrDecl([], param.type.type)
+
+                    param.type = PtrDecl([], param.type)
+                    param.storage = []
+                    param.funcspec = []
+
+                for node, _ in local_urs:
+                    node.replace(UnaryOp("*", node[0]))
+
+                def break2return(node: Node):
+                    for slot in node.__slots__:
+                        child = getattr(node, slot)
+                        if isinstance(child, list):
+                            for i in range(len(child)):
+                                if child[i].__class__ in (For, While, Switch):
+                                    break
+                                elif isinstance(child[i], Break):
+                                    child[i:i+1] = [Return(None)]
+                                elif isinstance(child[i], Node):
+                                    break2return(child[i])
+                        elif child.__class__ in (For, While, Switch):
+                            break
+                        elif isinstance(child, Break):
+                            setattr(node, slot, Return(None))
+                        elif isinstance(child, Node):
+                            break2return(child)
+                break2return(stmts[0])
+
+                # create function at the start of the program
+                call = FuncCall(ID(name), ExprList([ID(id) for id in local_names]))
+                void_function = _declare_void_function(name, params)
+                void_function = _define_function(name, void_function, Compound([If(stmts[0].cond, Compound([stmts[0].stmt, call]), None)]))
+                parent_pos    = _find_parent_pos_in_ext(parents)
+                parents[0].ext.insert(parent_pos, void_function)
+                # call the function
+                stmts.replace(FuncCall(ID(name), ExprList([UnaryOp("&", ID(id)) for id in local_names])))
+
+            return transform
+
+        return Deferred(validate)
 
 
 @find_statements(length=1, modifiable_length=False, context=True)
@@ -226,8 +239,6 @@ def insert_method(finder: FindStatements, parents: List[Node], stmts: Content, c
                 return
             params = func_def.decl.type.args
             params = params.params if params else []
-            if any(not can_rename(p.type) for p in params):
-                return
 
             # create free names for temporary storage of params
             param_names = {p.name for p in params}
@@ -240,7 +251,7 @@ def insert_method(finder: FindStatements, parents: List[Node], stmts: Content, c
                     result = Compound([])
                     # temporary store params with the temporary names
                     for expr, name, param in zip(call.args.exprs, temp_names, params):
-                        decl = deepcopy(param)
+                        decl = clone(param)
                         rename(decl, name)
                         decl.init = expr
                         result.block_items.append(decl)
@@ -249,15 +260,21 @@ def insert_method(finder: FindStatements, parents: List[Node], stmts: Content, c
                     # store the values in params with the right name
                     result.block_items.append(inner)
                     for name, param in zip(temp_names, params):
-                        decl = deepcopy(param)
+                        decl = clone(param)
                         decl.init = ID(name)
                         inner.block_items.append(decl)
-                    inner.block_items.append(deepcopy(func_def.body))
+                    inner.block_items.append(clone(func_def.body))
                     stmts.replace(result)
                 else:
-                    stmts.replace(deepcopy(func_def.body))
+                    stmts.replace(clone(func_def.body))
 
-            return transform
+            # the params are only checked once this transform is chosen
+            def validate():
+                if any(not can_rename(p.type) for p in params):
+                    return
+                return transform
+
+            return Deferred(validate)
 
 
 # Helper ----------------------------------------------------------------
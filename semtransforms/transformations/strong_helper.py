@@ -1,9 +1,7 @@
-from copy import deepcopy
-
 from pycparser.c_ast import *
 
 from semtransforms.transformation import *
-from semtransforms.util import simple_declaration, replace
+from semtransforms.util import simple_declaration, replace, clone
 
 
 @find_statements(length=1, modifiable_length=False)
@@ -72,10 +70,8 @@ def fast_compound(self, parents: List[Node], stmts: Content, context: ContextVis
         if start < end:
             stmts.nodes[start:end] = [Compound(stmts.nodes[start:end])]
 
-    def call_transform(index):  # this is in a function so that the index is not updated
-        return lambda: transform(index)
-
-    return [call_transform(i) for i in range(possibilities)]
+    # the transforms are only created when they are accessed
+    return LazyTransforms(possibilities, lambda index: lambda: transform(index))
 
 
 @find_statements(context=True, length=1)
@@ -87,6 +83,9 @@ def extract_if(self, parents: List[Node], stmts: Content, context: ContextVisito
             if len(type) != 1:
                 return
             type = next(iter(type))
+            if not isinstance(type, Node):
+                # the type is "UNDEFINED"
+                return
 
             def transform():
                 stmts.replace(Compound([simple_declaration(name, type, part.cond), stmts[0]]))
@@ -100,7 +99,7 @@ def expand_assignment(self, parents: List[Node], expr: SingleNode, context: Cont
     match expr[0]:
         case c_ast.Assignment(op=op, lvalue=left) as assignment if op != "=" and not self.has_side_effects(left):
             def transform():
-                assignment.rvalue = BinaryOp(assignment.op[:-1], deepcopy(assignment.lvalue), assignment.rvalue)
+                assignment.rvalue = BinaryOp(assignment.op[:-1], clone(assignment.lvalue), assignment.rvalue)
                 assignment.op = assignment.op[-1:]
             return transform
 
@@ -127,7 +126,7 @@ def extract_unary(self, parents: List[Node], stmts: Content, context: ContextVis
             return
         name = context.free_name(prefix = "var_")
         type = context.type(expr, name)
-        if len(type) == 1:
+        if len(type) == 1 and isinstance(next(iter(type)), Node):
             def transform():
                 part = getattr(stmts[0], attr_name)
                 stmts.replace(Compound([simple_declaration(name, next(iter(type)), part.expr), stmts[0]]))
@@ -1,3 +1,5 @@
+import typing
+
 import pycparser
 from pycparser import c_ast, c_generator
 from pycparser.c_ast import Node
@@ -10,6 +12,143 @@ class NoNode(Node):
         yield
 
 
+class ParentChain(typing.Sequence):
+    """
+    immutable list of parents, pushing a node shares all parents with the chain it is pushed on.
+    The first and last parent can be accessed in constant time, other indices walk from the end.
+    """
+    __slots__ = ("node", "parent", "length", "root", "func_defs")
+
+    def __init__(self, node: Node = None, parent: "ParentChain" = None):
+        self.node = node
+        self.parent = parent
+        if parent is None:
+            self.length = 0
+            self.root = None
+            self.func_defs = ()
+        else:
+            self.length = parent.length + 1
+            self.root = parent.root if parent.length else node
+            # function definitions in the chain, used to check whether a transform is allowed without a search
+            self.func_defs = parent.func_defs + (node,) if node.__class__ is c_ast.FuncDef else parent.func_defs
+
+    @staticmethod
+    def of(nodes: typing.Iterable[Node]) -> "ParentChain":
+        """returns nodes as ParentChain"""
+        if isinstance(nodes, ParentChain):
+            return nodes
+        chain = ParentChain()
+        for node in nodes:
+            chain = ParentChain(node, chain)
+        return chain
+
+    def push(self, node: Node) -> "ParentChain":
+        return ParentChain(node, self)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index == -1 and self.length:
+            return self.node
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("parent index out of range")
+        if index == 0:
+            return self.root
+        chain = self
+        for _ in range(self.length - 1 - index):
+            chain = chain.parent
+        return chain.node
+
+    def __reversed__(self):
+        chain = self
+        while chain.length:
+            yield chain.node
+            chain = chain.parent
+
+    def __iter__(self):
+        return iter(list(reversed(self))[::-1])
+
+    def __add__(self, nodes: typing.Iterable[Node]) -> "ParentChain":
+        chain = self
+        for node in nodes:
+            chain = ParentChain(node, chain)
+        return chain
+
+    def __eq__(self, other):
+        return isinstance(other, typing.Sequence) and list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def preorder(node: Node, skip_childs: typing.Callable[[Node], bool] = None) -> typing.Iterator[Node]:
+    """
+    iterates through a node and its descendants in the same order as a recursive traversal, but with an explicit stack.
+    The childs of a node are read after it was returned, thus they may be changed in between.
+    The childs of nodes for which skip_childs returns True are not visited.
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if skip_childs is None or not skip_childs(node):
+            childs = list(node)
+            childs.reverse()
+            stack += childs
+
+
+_ATTRIBUTES: typing.Dict[type, typing.Tuple[str, ...]] = {}
+
+
+def _attributes(cls: type) -> typing.Tuple[str, ...]:
+    """the attributes of a node class which are copied by clone"""
+    attributes = _ATTRIBUTES.get(cls)
+    if attributes is None:
+        slots = (name for c in cls.__mro__ for name in getattr(c, "__slots__", ()))
+        attributes = _ATTRIBUTES[cls] = tuple(name for name in slots if name not in ("__weakref__", "__dict__"))
+    return attributes
+
+
+def clone(node: typing.Union[Node, typing.List[Node]]):
+    """
+    copies a node or a list of nodes with all descendants like copy.deepcopy, but with an explicit stack.
+    Nodes and lists are copied, nodes which occur several times are copied once.
+    Strings, coords and the names of IdentifierTypes are never changed, thus they are shared with the original.
+    """
+    copies: typing.Dict[int, Node] = {}
+    stack = []
+
+    def copy(value):
+        if isinstance(value, Node):
+            result = copies.get(id(value))
+            if result is None:
+                result = copies[id(value)] = value.__class__.__new__(value.__class__)
+                stack.append((value, result))
+            return result
+        if value.__class__ is list:
+            return [copy(v) for v in value]
+        return value
+
+    result = copy(node)
+    while stack:
+        original, copied = stack.pop()
+        for name in _attributes(original.__class__):
+            value = getattr(original, name)
+            if value.__class__ is list and (name != "names" or original.__class__ is not c_ast.IdentifierType):
+                value = [copy(v) for v in value]
+            elif isinstance(value, Node):
+                value = copy(value)
+            setattr(copied, name, value)
+        if hasattr(original, "__dict__"):
+            copied.__dict__.update({name: copy(value) for name, value in original.__dict__.items()})
+    return result
+
+
 def fnn(*args):
     """first not none: returns first argument which is not None"""
     for arg in args:
@@ -26,6 +165,15 @@ def generate(node: Node, generator=c_generator.CGenerator()) -> str:
     return generator.visit(node)
 
 
+def generate_top_level(node: Node, generator=c_generator.CGenerator()) -> str:
+    """generates a node in FileAST.ext in the same way as it is generated as part of the FileAST"""
+    if isinstance(node, c_ast.FuncDef):
+        return generator.visit(node)
+    if isinstance(node, c_ast.Pragma):
+        return generator.visit(node) + '\n'
+    return generator.visit(node) + ';\n'
+
+
 def simple_declaration(name: str, type: Node, init: Node):
     return c_ast.Decl(name, [], [], [], [], [], c_ast.TypeDecl(name, [], None, type, []), init, None)
 
@@ -74,26 +222,23 @@ def duplicateable(node: Node, ignore_case=False):
     returns whether this code segment may exist twice in a method.
     labels and case statements outside a switch may not be duplicated
     """
-    match node:
-        case c_ast.Switch():
-            for child in node:
-                if not duplicateable(child, True):
-                    return False
-            return True
-        case c_ast.Case() | c_ast.Default() if not ignore_case:
-            return False
-        case c_ast.Label():
-            return False
-    for child in node:
-        if not duplicateable(child, ignore_case):
-            return False
+    stack = [(node, ignore_case)]
+    while stack:
+        node, ignore_case = stack.pop()
+        match node:
+            case c_ast.Switch():
+                ignore_case = True
+            case c_ast.Case() | c_ast.Default() if not ignore_case:
+                return False
+            case c_ast.Label():
+                return False
+        stack += ((child, ignore_case) for child in node)
     return True
 
 
 def has_variable_array_size(node: Node):
     if node is None: return False
-    return (isinstance(node, c_ast.ArrayDecl) and not isinstance(node.dim, c_ast.Constant)) \
-           or any(has_variable_array_size(child) for child in node)
+    return any(isinstance(n, c_ast.ArrayDecl) and not isinstance(n.dim, c_ast.Constant) for n in preorder(node))
 
 
 def can_rename(node: Node):
@@ -0,0 +1,230 @@
+import collections
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import typing
+import zlib
+
+import pycparser
+from pycparser import c_ast
+from pycparser.c_ast import Node
+from pycparser.plyparser import ParseError
+
+from semtransforms.util import parse
+
+# changes whenever the stored format changes, thus older entries are not loaded anymore
+_FORMAT = 1
+
+# tokens which are needed to find the top level declarations: strings, chars, preprocessor lines and brackets
+_TOKENS = re.compile(r'"(?:\\.|[^\\"\n])*"|\'(?:\\.|[^\\\'\n])*\'|^[ \t]*#[^\n]*|[;{}()\[\]]', re.M)
+_LINE_END = re.compile(r"[ \t\r]*(\n|$)")
+# a line marker, e.g. # 1 "/usr/include/stdio.h" 1 3 4
+_LINE_MARKER = re.compile(r'[ \t]*#[ \t]*(?:line[ \t]+)?\d+[ \t]+"([^"]*)"')
+# line markers of .c files in a prelude are always followed by one of a header, thus they do not change its AST
+_SOURCE_MARKERS = re.compile(r'^[ \t]*#[ \t]*(?:line[ \t]+)?\d+[ \t]+"[^"\n]*\.c".*$', re.M)
+# functions of the verifier are only declared by the user code
+_USER_CODE = re.compile(r"\b(__VERIFIER_\w*|reach_error)\b")
+
+
+def split_prelude(code: str) -> int:
+    """
+    returns the length of the prelude of the code, the declarations of the headers before the code of the user.
+    The user code starts with the first function definition, code after a line marker of a .c file
+    or function of the verifier.
+    The prelude ends at the start of a line after a top level declaration, thus the code after it can be parsed alone.
+    """
+    user_code = _USER_CODE.search(code)
+    end = user_code.start() if user_code else len(code)
+    prelude = 0
+    depth = 0
+    last = ""
+    # whether the last line marker belongs to a .c file
+    source = False
+    for token in _TOKENS.finditer(code, 0, end):
+        text = token.group()
+        match text.lstrip()[0]:
+            case "#":
+                if marker := _LINE_MARKER.match(text):
+                    source = marker.group(1).endswith(".c")
+            case _ if source:
+                break
+            case "{" if depth == 0 and last == ")":
+                # the body of a function definition
+                break
+            case "(" | "[" | "{":
+                depth += 1
+            case ")" | "]" | "}":
+                depth -= 1
+            case ";" if depth == 0:
+                line_end = _LINE_END.match(code, token.end())
+                if line_end:
+                    prelude = line_end.end()
+        last = text
+    return prelude
+
+
+class _PreludeParser(pycparser.CParser):
+    """a parser which continues parsing after a prelude was parsed"""
+
+    def parse_prelude(self, code: str) -> typing.Tuple[c_ast.FileAST, tuple]:
+        """parses a prelude, returns its AST and the state of the parser after it"""
+        ast = self.parse(code)
+        return ast, (dict(self._scope_stack[0]), self.clex.filename, self.clex.lexer.lineno)
+
+    def parse_after(self, code: str, state: tuple) -> c_ast.FileAST:
+        """parses the code after a prelude like it is parsed as part of the whole code"""
+        scope, filename, lineno = state
+        self.clex.filename = filename
+        self.clex.lexer.lineno = lineno
+        # typedefs of the prelude are types in the code after it
+        self._scope_stack = [dict(scope)]
+        self._last_yielded_token = None
+        return self.cparser.parse(input=code, lexer=self.clex)
+
+
+_parser: typing.Optional[_PreludeParser] = None
+
+
+def _prelude_parser() -> _PreludeParser:
+    global _parser
+    if _parser is None:
+        _parser = _PreludeParser()
+    return _parser
+
+
+class ParseCache:
+    """
+    ASTs stored on disk, keyed by a hash of the parsed code and the parser version.
+    The entries are compressed pickles, which are loaded several times faster than the code is parsed.
+    The least recently used entries are removed once the entries take more than max_size bytes.
+    Several processes may use the same directory, an entry is only visible once it was written completely.
+    Without a directory nothing is stored on disk.
+
+    The preludes of headers, which many files start with, are parsed once and reused, see parse.
+    The last used preludes are kept in memory, they are stored on disk as well.
+    """
+    def __init__(self, directory: typing.Optional[str] = None, max_size: int = 1 << 30,
+                 preludes: int = 16, min_prelude: int = 10000):
+        self.directory = directory
+        self.max_size = max_size
+        # pickled preludes and the state of the parser after them, the last used one is at the end
+        self._preludes: typing.OrderedDict[str, bytes] = collections.OrderedDict()
+        self.preludes = preludes
+        # shorter preludes are parsed with the rest of the code
+        self.min_prelude = min_prelude
+
+    def key(self, code: str, kind: str = "ast") -> str:
+        prefix = f"{_FORMAT}:{pycparser.__version__}:{kind}:".encode()
+        return hashlib.sha256(prefix + code.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".ast")
+
+    def _read(self, key: str) -> typing.Optional[bytes]:
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as r:
+                data = r.read()
+            # the access time is not updated on every file system, thus the modification time marks the last use
+            os.utime(path)
+            return zlib.decompress(data)
+        except (OSError, zlib.error):
+            # the entry does not exist, another process evicted it or it is damaged
+            return None
+
+    def _write(self, key: str, data: bytes):
+        if self.directory is None:
+            return
+        data = zlib.compress(data, 1)
+        if len(data) > self.max_size:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as w:
+                w.write(data)
+            os.replace(temp, self._path(key))
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        self.evict()
+
+    def load(self, code: str) -> typing.Optional[Node]:
+        """returns the stored AST of the code or None if there is none"""
+        data = self._read(self.key(code))
+        try:
+            return None if data is None else pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError):
+            return None
+
+    def store(self, code: str, ast: Node):
+        """stores the AST of the code, ASTs which are too deep to be pickled are not stored"""
+        if self.directory is None:
+            return
+        try:
+            data = pickle.dumps(ast, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            return
+        self._write(self.key(code), data)
+
+    def parse(self, code: str) -> c_ast.FileAST:
+        """
+        parses the code, its prelude is parsed once and reused for all code starting with the same prelude.
+        The result is the same as the one of util.parse, including the coordinates and the nodes shared by declarations.
+        """
+        length = split_prelude(code)
+        if length < self.min_prelude or not code[length:].strip():
+            return parse(code)
+        prelude = code[:length]
+        key = self.key(_SOURCE_MARKERS.sub("", prelude), "prelude")
+        parser = _prelude_parser()
+        try:
+            data = self._preludes.get(key) or self._read(key)
+            if data is None:
+                ast, state = parser.parse_prelude(prelude)
+                ext = ast.ext
+                try:
+                    data = pickle.dumps((ext, state), pickle.HIGHEST_PROTOCOL)
+                except RecursionError:
+                    data = None
+                else:
+                    self._write(key, data)
+            else:
+                # the prelude is unpickled for each code, thus changes of one AST do not affect the others
+                ext, state = pickle.loads(data)
+            rest = parser.parse_after(code[length:], state)
+        except ParseError:
+            # the error is reported for the whole code
+            return parse(code)
+        if data is not None:
+            self._preludes[key] = data
+            self._preludes.move_to_end(key)
+            while len(self._preludes) > self.preludes:
+                self._preludes.popitem(last=False)
+        return c_ast.FileAST(ext + rest.ext)
+
+    def evict(self):
+        """removes the least recently used entries until they take at most max_size bytes"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".ast"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
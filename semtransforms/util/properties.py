@@ -0,0 +1,91 @@
+import typing
+
+from pycparser import c_ast
+from pycparser.c_ast import Node
+
+from semtransforms.util import equals, preorder
+
+# properties of a node and its descendants, stored as bit flags
+SIDE_EFFECTS = 1
+BREAK = 2
+RETURN = 4
+JUMP = 8
+STRUCT_REF = 16
+FUNC_CALL = 32
+
+# properties of a node itself, independent of its childs
+_OWN = {
+    c_ast.Assignment: lambda node: SIDE_EFFECTS,
+    # Function might have a side effect
+    c_ast.FuncCall: lambda node: SIDE_EFFECTS | FUNC_CALL,
+    c_ast.UnaryOp: lambda node: SIDE_EFFECTS if node.op in "p++p--" else 0,
+    c_ast.Break: lambda node: BREAK,
+    c_ast.Return: lambda node: RETURN,
+    c_ast.Label: lambda node: JUMP,
+    c_ast.Goto: lambda node: JUMP,
+    c_ast.StructRef: lambda node: STRUCT_REF,
+}
+
+# properties of childs which do not apply to the node, breaks only leave the innermost loop or switch
+_HIDDEN = {
+    c_ast.Switch: BREAK,
+    c_ast.While: BREAK,
+    c_ast.For: BREAK,
+}
+
+
+def _no_properties(node: Node) -> int:
+    return 0
+
+
+class NodeProperties:
+    """
+    Properties of nodes, computed bottom-up once for all descendants of a node.
+    The properties are kept until a node is invalidated, thus modified nodes have to be invalidated.
+    """
+    def __init__(self):
+        self._flags: typing.Dict[Node, int] = {}
+        # results of comparisons with nodes which are never changed, like signatures
+        self._equals: typing.Dict[Node, typing.Dict[Node, bool]] = {}
+
+    def flags(self, node: Node) -> int:
+        """returns the properties of a node as bit flags"""
+        flags = self._flags
+        result = flags.get(node)
+        if result is not None:
+            return result
+        # a node is added a second time once all of its childs are known
+        stack = [(node, False)]
+        while stack:
+            current, childs_known = stack.pop()
+            if childs_known:
+                result = _OWN.get(current.__class__, _no_properties)(current)
+                hidden = ~_HIDDEN.get(current.__class__, 0)
+                for child in current:
+                    result |= flags[child] & hidden
+                flags[current] = result
+            elif current not in flags:
+                stack.append((current, True))
+                stack += [(child, False) for child in current if child not in flags]
+        return flags[node]
+
+    def has(self, node: Node, flag: int) -> bool:
+        return bool(self.flags(node) & flag)
+
+    def equals(self, node: Node, constant: Node) -> bool:
+        """returns whether a node is equal to a node which is never changed"""
+        results = self._equals.setdefault(node, {})
+        result = results.get(constant)
+        if result is None:
+            result = results[constant] = equals(node, constant)
+        return result
+
+    def invalidate(self, node: Node):
+        """forgets the properties of a node and its descendants"""
+        for n in preorder(node):
+            self._flags.pop(n, None)
+            self._equals.pop(n, None)
+
+    def clear(self):
+        self._flags.clear()
+        self._equals.clear()
@@ -1,12 +1,22 @@
-import copy
 import typing
 from functools import wraps, cache
 
 from pycparser import c_ast
 
-from semtransforms.transformation import Content
+from semtransforms.transformation import Content, FindNodes
 from semtransforms.context import ContextVisitor
-from semtransforms.util import equals, parse
+from semtransforms.util import clone, equals, parse
+
+
+# used to distinguish undeclared names from names declared with the value None
+_UNDECLARED = object()
+
+
+def _compatible(transform: FindNodes, declaration: c_ast.Node, signature: c_ast.Node) -> bool:
+    """whether a declaration is the expected signature, the comparisons are kept in the node properties"""
+    if not isinstance(declaration, c_ast.Node):
+        return equals(declaration, signature)
+    return transform.properties.equals(declaration, signature)
 
 
 @cache
@@ -38,17 +48,17 @@ def nondet(*types: str):
         def wrapper2(transform, parents: typing.List[c_ast.Node], stmts: Content, context: ContextVisitor):
             # find missing nondet definitions
             missing_types = []
-            names = context.all_levels()
             for name, t in types:
-                if name not in names:
+                declaration = context.value(name, default=_UNDECLARED)
+                if declaration is _UNDECLARED:
                     missing_types.append(t)
-                elif not equals(names[name], t):
+                elif not _compatible(transform, declaration, t):
                     return
             result = func(transform, parents, stmts, context)
             if result:
                 def enable():
                     # add nondet definitions which are not already there
-                    parents[0].ext[0:0] = copy.deepcopy(missing_types)
+                    parents[0].ext[0:0] = clone(missing_types)
                     result()
                 return enable
         return wrapper2
@@ -68,7 +78,7 @@ def error_call():
     Creates a call to the reach_error function.
     Should be always used in combination with error to ensure that the function exists.
     """
-    return copy.deepcopy(_ERROR_CALL)
+    return clone(_ERROR_CALL)
 
 
 def error(func):
@@ -78,15 +88,15 @@ def error(func):
     """
     @wraps(func)
     def wrapper(transform, parents: typing.List[c_ast.Node], stmts: Content, context: ContextVisitor):
-        names = context.all_levels()
-        definition_available = ERROR_NAME in names
-        if definition_available and not equals(names[ERROR_NAME], _ERROR_SIGNATURE):
+        declaration = context.value(ERROR_NAME, default=_UNDECLARED)
+        definition_available = declaration is not _UNDECLARED
+        if definition_available and not _compatible(transform, declaration, _ERROR_SIGNATURE):
             return False
         result = func(transform, parents, stmts, context)
         if result:
             def enable():
                 if not definition_available:
-                    parents[0].ext.insert(0, copy.deepcopy(_ERROR_SIGNATURE))
+                    parents[0].ext.insert(0, clone(_ERROR_SIGNATURE))
                 result()
             return enable
     return wrapper
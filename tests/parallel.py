@@ -0,0 +1,68 @@
+import os
+import time
+import unittest
+from collections import Counter
+
+from mapreduce import pmap, _batches
+
+
+def _sleep_on_3(x):
+    if x == 3:
+        time.sleep(100)
+    return x
+
+
+def _exit_on_3(x):
+    if x == 3:
+        os._exit(3)
+    return x, os.getpid()
+
+
+def _failed(item, reason):
+    return "failed", item, reason
+
+
+class RegexTest(unittest.TestCase):
+    def test_batches_largest_first(self):
+        self.assertEqual([[5], [3, 2], [1]], _batches([1, 5, 3, 2], lambda item: item, 2))
+
+    def test_batches_expensive_item(self):
+        # an item which costs more than a batch is not batched with others
+        self.assertEqual([[20], [1, 1, 1, 1]], _batches([1, 1, 20, 1, 1], lambda item: item, 4))
+
+    def test_batches_count(self):
+        batches = _batches(list(range(100)), lambda item: 1, 10)
+        self.assertEqual(10, len(batches))
+        self.assertEqual(list(range(100)), sorted(item for batch in batches for item in batch))
+
+    def test_pmap_outputs(self):
+        # every output arrives exactly once, in any order
+        outputs = Counter(pmap(lambda x: 2 * x, range(50), processes=3, cost=lambda x: x % 7))
+        self.assertEqual(Counter(2 * x for x in range(50)), outputs)
+
+    def test_pmap_serial(self):
+        # a single process or a single item is mapped in order by this process
+        self.assertEqual([(x, os.getpid()) for x in range(5)],
+                         list(pmap(lambda x: (x, os.getpid()), range(5), processes=1)))
+        self.assertEqual([(0, os.getpid())], list(pmap(lambda x: (x, os.getpid()), [0], processes=4)))
+
+    def test_pmap_timeout(self):
+        start = time.time()
+        outputs = list(pmap(_sleep_on_3, range(10), processes=2, timeout=0.5, failed=_failed))
+        self.assertLess(time.time() - start, 10)
+        self.assertIn(("failed", 3, "the worker process was killed after 0.5 seconds"), outputs)
+        self.assertEqual(sorted(set(range(10)) - {3}), sorted(x for x in outputs if isinstance(x, int)))
+
+    def test_pmap_exit(self):
+        outputs = list(pmap(_exit_on_3, range(10), processes=2, failed=_failed))
+        self.assertIn(("failed", 3, "the worker process exited with code 3"), outputs)
+        self.assertEqual(sorted(set(range(10)) - {3}), sorted(output[0] for output in outputs if output[0] != "failed"))
+
+    def test_pmap_max_tasks(self):
+        # each item is mapped by a new worker process, also after the process mapping one of them exited
+        outputs = list(pmap(_exit_on_3, range(10), processes=2, failed=_failed, max_tasks=1))
+        self.assertIn(("failed", 3, "the worker process exited with code 3"), outputs)
+        mapped = [output for output in outputs if output[0] != "failed"]
+        self.assertEqual(sorted(set(range(10)) - {3}), sorted(x for x, _ in mapped))
+        self.assertEqual(9, len({pid for _, pid in mapped}))
+        self.assertNotIn(os.getpid(), {pid for _, pid in mapped})
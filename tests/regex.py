@@ -51,4 +51,11 @@ class RegexTest(unittest.TestCase):
         self._test_regex("./benchmarks/array-2.c")
 
     def test_regex_bubblesort1(self):
-        self._test_regex("./benchmarks/bubblesort-1.c")
\ No newline at end of file
+        self._test_regex("./benchmarks/bubblesort-1.c")
+
+    def test_remove_comments(self):
+        code = 'int a; // "x\nchar *s = "/* // */\\""; /* \'\n*/ char c = \'"\'; /* unclosed'
+        self.assertEqual('int a;  \nchar *s = "/* // */\\"";   char c = \'"\'; /* unclosed',
+                         pretransformation.remove_comments(code))
+        # an unclosed char is code, thus the comment after it is removed
+        self.assertEqual("' ", pretransformation.remove_comments("'/* a */"))
@@ -1,8 +1,23 @@
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
 
 from pycparser import c_generator, c_parser
 
-from semtransforms import on_ast, insert_method, FindStatements, FindExpression, parse, generate
+from semtransforms import on_ast, iter_on_ast, parse_program, trace, add_empty_lists, insert_method, FindStatements, FindExpression, parse, generate, \
+    swap_binary, add_if1, extract_if, to_method, expand_assignment, re_ref_locals, add_nondet, flip_if, add_if_rand, \
+    arithmetic_nothing, FindNodes, time_limit, TimeLimitExceeded, transform
+from semtransforms.framework import Transformer
+from semtransforms.index import TransformIndex
+from semtransforms.util import ParentChain, clone, preorder
+from semtransforms.util.parse_cache import ParseCache, split_prelude
+from semtransforms.util.properties import NodeProperties, BREAK, SIDE_EFFECTS, FUNC_CALL
+from semtransforms.transformation import all_transforms, Transforms, LazyTransforms, references, \
+    unknown_references, search_tables, Bindings, Deferred
+from semtransforms.context import Scopes, ContextVisitor
 
 
 class RegexTest(unittest.TestCase):
@@ -60,3 +75,398 @@ class RegexTest(unittest.TestCase):
             }
         ''')
 
+
+    def test_all_transforms_shared(self):
+        code = '''
+            int main() {
+                int i = 0;
+                while (i < 10) {
+                    i += 1;
+                }
+                return i;
+            }
+        '''
+        transformations = [swap_binary, add_if1, extract_if, to_method, expand_assignment]
+
+        def counts(ast):
+            shared = all_transforms(ast, transformations)
+            return [(len(shared[t]), len(t.all_transforms(ast))) for t in transformations]
+
+        for shared, single in on_ast(code, counts)[0][1]:
+            self.assertEqual(single, shared)
+
+    def test_index_reuse(self):
+        code = '''
+            int f(int a) {
+                return a + 1;
+            }
+            int main() {
+                int i = 0;
+                while (i < 10) {
+                    i = f(i);
+                }
+                return i;
+            }
+        '''
+        transformations = [swap_binary, add_if1, extract_if, to_method, expand_assignment]
+
+        def apply(ast):
+            index = TransformIndex.of(ast)
+            for transform in transformations:
+                found = index.all_transforms(transformations)
+                self.assertEqual([len(t.all_transforms(ast)) for t in transformations],
+                                 [len(found[t]) for t in transformations])
+                if found[transform]:
+                    index.apply(transform, len(found[transform]) - 1)
+
+        on_ast(code, apply)
+
+    def test_lazy_transforms(self):
+        created = []
+
+        def create(i):
+            created.append(i)
+            return i
+
+        transforms = Transforms([-1], LazyTransforms(3, create), [], Transforms([3, 4]))
+        self.assertEqual(6, len(transforms))
+        self.assertEqual([2, 4], [transforms[3], transforms[-1]])
+        self.assertEqual([2], created)
+        self.assertEqual([-1, 0, 1, 2, 3, 4], list(transforms))
+        with self.assertRaises(IndexError):
+            transforms[6]
+
+    def test_parent_chain(self):
+        parents = ParentChain.of([1, 2])
+        child = parents.push(3)
+        self.assertEqual([1, 2], parents)
+        self.assertEqual([1, 2, 3], child)
+        self.assertEqual((1, 2, 3, 2), (child[0], child[1], child[-1], child[-2]))
+        self.assertEqual([1, 2, 3, 4], child + [4])
+        match child:
+            case [*_, 2, 3]:
+                pass
+            case _:
+                self.fail("parents can be matched like lists")
+
+    def test_deep_ast(self):
+        # deeper than the default recursion limit
+        depth = 1200
+        ast = parse("int main() { int i = 0; " + "while (i) { i = i + 1; " * depth + "}" * depth + " return i; }")
+        add_empty_lists(ast)
+        self.assertEqual(depth, len(swap_binary.all_transforms(ast)))
+        self.assertEqual(3 * depth + 1, len(add_if1.all_transforms(ast)))
+        self.assertEqual(3 * depth + 1, len(re_ref_locals.all_transforms(ast)))
+
+    def test_node_properties(self):
+        ast = parse("void f() { do { while (1) break; break; } while (g()); -x; }")
+        body = ast.ext[0].body
+        do_while, unary = body.block_items
+        properties = NodeProperties()
+        self.assertEqual(BREAK | SIDE_EFFECTS | FUNC_CALL, properties.flags(do_while))
+        self.assertFalse(properties.has(do_while.stmt.block_items[0], BREAK))
+        # the substring check of unary operators counts a negation as side effect
+        self.assertTrue(properties.has(unary, SIDE_EFFECTS))
+
+        do_while.stmt.block_items.pop()
+        do_while.cond = parse("int x = 1;").ext[0].init
+        properties.invalidate(body)
+        self.assertEqual(0, properties.flags(do_while))
+
+    def test_references(self):
+        ast = parse("int g; void f(int p) { int x = p; { int x = x + g; s.x = x; } x = __PRETTY_FUNCTION__[0]; }")
+        body = ast.ext[1].body
+        outer_x, inner = body.block_items[0], body.block_items[1]
+        names = lambda found: [expr[0].name for expr, parents in found]
+        # the field of s and the inner x are no references to the outer x
+        self.assertEqual(2, len(references(body, outer_x)))
+        self.assertEqual(["x"], names(references(inner, inner.block_items[0])))
+        self.assertEqual(["p", "g", "s"], names(unknown_references(body)))
+        # while searching, the bindings of the body are reused for the inner compound
+        bindings = Bindings()
+        with search_tables(NodeProperties(), Scopes(), bindings):
+            unknown_references(body)
+            found = unknown_references(inner)
+        self.assertEqual(["x", "g", "s"], names(found))
+        self.assertIs(inner, found[0][1][0])
+        self.assertEqual(names(found), names(unknown_references(inner)))
+
+    def test_deferred_validation(self):
+        # the variable length array can not be passed to a new function, which is only noticed when it is chosen
+        code = "void f(int n) { int a[n]; { a[0] = n; } { n = 2; } }"
+        self.assertEqual(1, on_ast(code, lambda ast: len(to_method.all_transforms(ast)))[0][1])
+        index = TransformIndex.of(parse(code))
+        self.assertEqual(2, len(index.all_transforms([to_method])[to_method]))
+        self.assertEqual([False, True], [index.validate(to_method, i) for i in range(2)])
+
+        # the first transform is chosen first, it is not valid and the next one is chosen instead
+        transformer = Transformer(to_method, transform_selector=lambda choices, weights: [choices[0]],
+                                  config_selector=lambda candidates: candidates[0])
+        (code_after, run), = on_ast(code, lambda ast: transformer.transform(ast))
+        self.assertEqual("to_method: 1", run)
+        self.assertEqual(code_after, trace(code, run, True, 1)[-1][0])
+
+        # an invalid candidate is replaced by the last one, each candidate is chosen at most once
+        code = "void f(int n) { int a[n]; { a[0] = n; } { a[1] = n; } { n = 2; } { a[2] = n; } }"
+        chosen = []
+        transformer = Transformer(to_method, transform_selector=lambda choices, weights: [choices[0]],
+                                  config_selector=lambda candidates: chosen.append(candidates[0]) or candidates[0])
+        (_, run), = on_ast(code, lambda ast: transformer.transform(ast))
+        self.assertEqual("to_method: 2", run)
+        self.assertEqual([0, 3, 2], chosen)
+
+    def test_verifier_declarations(self):
+        count = lambda code: on_ast(code, lambda ast: len(add_nondet.all_transforms(ast)))[0][1]
+        self.assertEqual(2, count("int main() { return 0; }"))
+        self.assertEqual(2, count("extern int __VERIFIER_nondet_int(); int main() { return 0; }"))
+        # a declaration with another signature can not be used
+        self.assertEqual(0, count("extern long __VERIFIER_nondet_int(); int main() { return 0; }"))
+        # the function is declared after the statements
+        self.assertEqual(2, count("int main() { return 0; } extern long __VERIFIER_nondet_int();"))
+
+    def test_types(self):
+        ast = parse("struct S { int a; long b; }; void f(struct S s) { s.b = s.a + 1; }")
+        assignment = ast.ext[1].body.block_items[0]
+        scopes = Scopes()
+        found = []
+
+        def visit_node(visitor, current, parents, index):
+            if current is assignment:
+                found.append(visitor.type(assignment.rvalue))
+                found.append(visitor.type(assignment.lvalue))
+                found.append(visitor.type(assignment.rvalue.left))
+                found.append(visitor.type(assignment.rvalue, "x"))
+
+        with search_tables(NodeProperties(), scopes, Bindings()):
+            ContextVisitor(ast, visit_node, "test", True)
+        self.assertEqual([["int"], ["long"], ["int"], ["int"]], [[t.names[0] for t in types] for types in found])
+        # the types are kept in the scopes for each name and are the same objects for other visitors
+        self.assertIs(found[0], scopes.types(assignment.rvalue)[None])
+        self.assertIs(found[3], scopes.types(assignment.rvalue)["x"])
+        scopes.invalidate(assignment)
+        self.assertEqual({}, scopes.types(assignment.rvalue))
+
+    def test_free_name(self):
+        # the name collides with a global, a parameter, a later declaration, a later function and a given name
+        ast = parse("int n_0; void f(int n_1) { int x;\nx = 1;\nint n_2; } void n_3() {}".replace("n_", "t_line_2_to_2_"))
+        statement = ast.ext[1].body.block_items[1]
+        names = []
+
+        def visit_node(visitor, current, parents, index):
+            if current is statement:
+                names.append(visitor.free_name(used_names=["t_line_2_to_2_4"]))
+
+        with search_tables(NodeProperties(), Scopes(), Bindings()):
+            ContextVisitor(ast, visit_node, "t", True)
+        self.assertEqual(["t_line_2_to_2_5"], names)
+
+    def test_failures(self):
+        FindNodes.reset_failures()
+        # neither the expression of a case nor pointer arithmetic raise exceptions while searching
+        code = "int f(int *p, int x) { switch (x) { case 1: x = *p + 1; } return p + x == 0; }"
+        on_ast(code, lambda ast: all_transforms(ast, [flip_if, arithmetic_nothing, extract_if]))
+        self.assertEqual({}, FindNodes.failure_statistics())
+
+        deferred = Deferred(lambda: 1 // 0)
+        deferred.transformation = to_method
+        self.assertFalse(deferred.valid())
+        failures = FindNodes.failure_statistics()
+        self.assertEqual(["to_method"], list(failures))
+        self.assertEqual(1, failures["to_method"]["count"])
+        self.assertEqual({"ZeroDivisionError": 1}, failures["to_method"]["types"])
+        FindNodes.reset_failures()
+
+    def test_clone(self):
+        ast = parse("int f(int x) { unsigned int y = x; while (y) { y = y - 1; } return y; }")
+        copied = clone(ast)
+        self.assertEqual(generate(ast), generate(copied))
+        nodes, copied_nodes = list(preorder(ast)), list(preorder(copied))
+        self.assertEqual([n.__class__ for n in nodes], [n.__class__ for n in copied_nodes])
+        self.assertFalse({id(n) for n in nodes} & {id(n) for n in copied_nodes})
+        # leaves which are never changed are shared
+        names = [n for n in nodes if n.__class__.__name__ == "IdentifierType"]
+        copied_names = [n for n in copied_nodes if n.__class__.__name__ == "IdentifierType"]
+        self.assertTrue(all(n.names is c.names for n, c in zip(names, copied_names)))
+        self.assertIs(nodes[1].coord, copied_nodes[1].coord)
+        # lists of statements are not shared and a node which occurs twice is copied once
+        self.assertIsNot(ast.ext[0].body.block_items, copied.ext[0].body.block_items)
+        node = ast.ext[0].body.block_items[-1]
+        twice = clone([node, node])
+        self.assertIs(twice[0], twice[1])
+        self.assertIsNot(node, twice[0])
+
+    def test_localized_normalization(self):
+        # the first step normalizes all top level nodes, later ones only the changed ones
+        code = "int g(int x) { if (x) x = 1; return x; } int f(int x) { return x + 1; } int h;"
+        expected = on_ast(code, lambda ast: swap_binary.all_transforms(ast)[0]())[0][0]
+        self.assertIn("int h;\nint g", expected)
+        self.assertIn("{\n    x = 1;\n  }", expected)
+
+        ast = parse(code)
+        add_empty_lists(ast)
+        index = TransformIndex.of(ast)
+        index.all_transforms([swap_binary])
+        index.apply(swap_binary, 0)
+        self.assertEqual(expected, generate(ast))
+        # a new if without compounds in another top level node is not normalized again
+        ast.ext[1].body.block_items[0].iffalse = None
+        index.all_transforms([swap_binary])
+        index.apply(swap_binary, 0)
+        self.assertIsNone(ast.ext[1].body.block_items[0].iffalse)
+
+    def test_generate_cache(self):
+        # the code of top level nodes is generated again only after they were changed
+        ast = parse("int g(int x) { return x + 1; } int f(int x) { return x * 2; } int h;")
+        add_empty_lists(ast)
+        index = TransformIndex.of(ast)
+        self.assertEqual(generate(ast), TransformIndex.generate(ast))
+        f = ast.ext[1]
+        cached = index._code[f]
+        index.all_transforms([swap_binary])
+        index.apply(swap_binary, 0)
+        self.assertEqual(generate(ast), TransformIndex.generate(ast))
+        self.assertIs(cached, index._code[f])
+        self.assertIn("return 1 + x;", TransformIndex.generate(ast))
+
+    def test_outside_changes(self):
+        # the index finds the top level nodes which were changed without it once it is used again
+        ast = parse("int f(int x) { return x + 1; } int g() { return 2 * 3; }")
+        add_empty_lists(ast)
+        index = TransformIndex.of(ast)
+        index.all_transforms([swap_binary])
+        index.apply(swap_binary, 0)
+        ast.ext[1].body = parse("int g() { return 4 * 5; }").ext[0].body
+        self.assertIs(index, TransformIndex.of(ast))
+        index.all_transforms([swap_binary])
+        index.apply(swap_binary, 1)
+        self.assertIn("return 5 * 4;", generate(ast))
+        ast.ext[0].body.block_items[0].expr.op = "-"
+        self.assertEqual(1, len(TransformIndex.of(ast).all_transforms([swap_binary])[swap_binary]))
+
+    def test_on_ast_without_index(self):
+        # operations which change the AST without the index are part of the generated code
+        results = on_ast("int f(int x) { if (x) { x = 1; } return x + 2; }",
+                         lambda ast: Transformer(flip_if).transform(ast, 1),
+                         lambda ast: swap_binary.all_transforms(ast)[0]())
+        self.assertIn("if (!x)", results[0][0])
+        self.assertIn("return 2 + x;", results[1][0])
+
+    def test_trace_checkpoints(self):
+        # each checkpoint replays its own part of the trace
+        results = trace("int f(int x) { return x + 1; }", "swap_binary: 0\nadd_if1: 0", True, 1, 2)
+        self.assertEqual(["swap_binary: 0", "add_if1: 0"], [run for _, run in results])
+        self.assertIn("return 1 + x;", results[0][0])
+        self.assertNotIn("if (1)", results[0][0])
+        self.assertIn("if (1)", results[1][0])
+        self.assertIn("return 1 + x;", results[1][0])
+
+    def test_random_names_seeded(self):
+        # without pretty names the new functions get random names, which are the same for the same seed
+        code = "int main() { int x = 0; { x = x + 1; } { x = x * 2; } return x; }"
+        results = []
+        for _ in range(2):
+            random.seed(3)
+            results.append(transform(code, Transformer(to_method), False, 2))
+        self.assertEqual(results[0], results[1])
+        self.assertNotIn("to_method_", results[0][0][0])
+        self.assertEqual(4, results[0][0][0].count("func_"))
+
+    def test_iter_on_ast(self):
+        # the operations are only applied once the code before them was consumed
+        applied = []
+        results = iter_on_ast("int f(int x) { return x + 1; }",
+                              lambda ast: applied.append(1) or swap_binary.all_transforms(ast)[0]() or "first",
+                              lambda ast: applied.append(2) or "second")
+        self.assertEqual([], applied)
+        code, result = next(results)
+        self.assertEqual(([1], "first"), (applied, result))
+        self.assertIn("return 1 + x;", code)
+        self.assertEqual([("int f(int x)\n{\n  return 1 + x;\n}\n\n", "second")], list(results))
+        self.assertEqual([1, 2], applied)
+
+    def test_parse_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ParseCache(directory)
+            code = "int f(int x) { if (x) { } return x + 1; }"
+            self.assertIsNone(cache.load(code))
+            ast = parse_program(code, cache)
+            loaded = cache.load(code)
+            self.assertIsNot(ast, loaded)
+            self.assertEqual(generate(ast), generate(loaded))
+            # the loaded AST already contains the empty lists
+            self.assertEqual([], loaded.ext[0].body.block_items[0].iftrue.block_items)
+            # the least recently used entries are removed once the cache is full
+            cache.max_size = os.path.getsize(os.path.join(directory, cache.key(code) + ".ast"))
+            other = "int g;"
+            time.sleep(0.01)
+            parse_program(other, cache)
+            self.assertIsNone(cache.load(code))
+            self.assertIsNotNone(cache.load(other))
+
+    def test_prelude(self):
+        # the declarations of headers before the first function are parsed once
+        prelude = '# 1 "/usr/include/types.h"\ntypedef int size_t;\nstruct s { size_t a, b; };\nextern size_t f(void);\n'
+        cache = ParseCache(min_prelude=0)
+        first, second = (prelude + f'# 5 "{name}.c"\nint {name}(size_t x) {{ size_t y = (size_t) x; return y; }}\n'
+                         for name in ("first", "second"))
+        self.assertEqual(len(prelude), split_prelude(first))
+        for code in first, second, second:
+            expected, ast = parse(code), cache.parse(code)
+            self.assertEqual(generate(expected), generate(ast))
+            self.assertEqual([str(node.coord) for node in preorder(expected)], [str(node.coord) for node in preorder(ast)])
+        self.assertEqual(1, len(cache._preludes))
+        self.assertIsNot(cache.parse(second).ext[0], ast.ext[0])
+
+    def test_to_method_later_function(self):
+        # a function which is called before it is defined is no variable which can be passed to the new function
+        ast = parse("int main() { int x = 0; { x = g(x); } return x; } int g(int a) { return a; }")
+        add_empty_lists(ast)
+        self.assertEqual([], list(to_method.all_transforms(ast)))
+
+    def test_blacklisted_bodies(self):
+        # functions which may not be edited are not searched
+        ast = parse("void reach_error() { int a = 1 + 2; } int f(int x) { return x + 1; }")
+        add_empty_lists(ast)
+        visited = []
+        original = swap_binary._all_allowed_transforms
+        swap_binary._all_allowed_transforms = lambda node, *args: visited.append(node) or original(node, *args)
+        try:
+            self.assertEqual(1, len(swap_binary.all_transforms(ast)))
+        finally:
+            del swap_binary._all_allowed_transforms
+        self.assertIn(ast.ext[0], visited)
+        self.assertNotIn(ast.ext[0].body, visited)
+        self.assertIn(ast.ext[1].body, visited)
+
+    def test_time_limit(self):
+        # the exceeded limit is not swallowed by the transformation searched at that time
+        ast = parse("int f(int x) { return x + 1; }")
+        add_empty_lists(ast)
+        start = time.time()
+        with self.assertRaises(TimeLimitExceeded):
+            with time_limit(0.05):
+                while True:
+                    swap_binary.all_transforms(ast)
+        self.assertLess(time.time() - start, 1)
+        with time_limit(None):
+            self.assertEqual(1, len(swap_binary.all_transforms(ast)))
+
+    def test_time_limit_thread(self):
+        # outside of the main thread the same exception is raised in the thread which is limited
+        ast = parse("int f(int x) { return x + 1; }")
+        add_empty_lists(ast)
+        raised = []
+
+        def run():
+            try:
+                with time_limit(0.05):
+                    while True:
+                        swap_binary.all_transforms(ast)
+            except TimeLimitExceeded as e:
+                raised.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(raised))